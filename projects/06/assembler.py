@@ -21,7 +21,6 @@ symbol_table = { "R0"  :  0,
                  "THAT"   : 4,
                  "SCREEN" : 0x4000,
                  "KBD"    : 0x6000 }
-cur_register = 16
 
 instr_table = { "0"   : "0101010",
                 "1"   : "0111111",
@@ -29,7 +28,7 @@ instr_table = { "0"   : "0101010",
                 "D"   : "0001100",
                 "A"   : "0110000",
                 "!D"  : "0001101",
-                "!A"  : "0110011",
+                "!A"  : "0110001",
                 "-D"  : "0001111",
                 "-A"  : "0110011",
                 "D+1" : "0011111",
@@ -69,54 +68,124 @@ jump_table = { "JGT" : "001",
                "JLE" : "110",
                "JMP" : "111" }
 
-import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument("input")
-args = parser.parse_args()
-input_file = args.input
-output_file = input_file.split(".")[0] + ".hack"
-f = open(input_file, 'r')
-output = open(output_file, 'w')
-instructions = []
-
-# First pass to populate symbol table and strip comments
-for line in f.readlines():
+import argparse, functools
+from hack_rom import write_hack, write_rom
+
+def strip_comment(line):
     comment = line.find("//")
-    if comment == -1:  
-        line = line.strip()
+    if comment == -1:
+        return line.strip()
+    return line[:comment].strip()
+
+# First pass: record the ROM offset of every label. Nothing else is kept.
+def find_labels(lines):
+    labels = {}
+    offset = 0
+    for line in lines:
+        line = strip_comment(line)
+        if line != "":
+            if line[0] == '(':
+                labels[line[1:-1]] = offset
+            else:
+                offset += 1
+    return labels
+
+def normalize_dest(dst, text):
+    if dst == "" or len(set(dst)) != len(dst) or not set(dst) <= set("AMD"):
+        raise Exception("Invalid destination in C-instruction: " + text)
+    return "".join([r for r in "AMD" if r in dst])
+
+# D+A and A+D, M|D and D|M, ... are the same computation.
+def normalize_comp(comp, text):
+    if comp not in instr_table and len(comp) == 3 and comp[1] in "+&|":
+        comp = comp[2] + comp[1] + comp[0]
+    if comp not in instr_table:
+        raise Exception("Invalid computation in C-instruction: " + text)
+    return comp
+
+def compile_c(text):
+    instruction = "".join(text.split())
+    dst_split = instruction.split("=", 1)
+    if len(dst_split) > 1:
+        dst = dest_table[normalize_dest(dst_split[0], text)]
+        instruction = dst_split[1]
     else:
-        line = line[:comment].strip()
-    if line != "":
-        if line[0] == '(':
-            symbol_table[line[1:-1]] = len(instructions)
-        else:
-            instructions.append(line)
-            
-# Second pass to populate the .hack file
-for instruction in instructions:
-    if instruction[0] == "@":
-        symbol = instruction[1:]
-        if symbol[0].isalpha(): # This is a symbol
-            if symbol not in symbol_table:
-                symbol_table[symbol] = cur_register
-                cur_register += 1
-            val = symbol_table[symbol]
-        else:
-            val = int(symbol)
-        output.write("{0:{fill}16b}\n".format(val, fill='0'))
+        dst = "000"
+    # calculation part is always populated
+    jump_split = instruction.split(";", 1)
+    if len(jump_split) > 1:
+        if jump_split[1] not in jump_table:
+            raise Exception("Invalid jump in C-instruction: " + text)
+        jmp = jump_table[jump_split[1]]
+        instruction = jump_split[0]
     else:
-        dst_split = instruction.split("=")
-        if len(dst_split) > 1:
-            dst = dest_table[dst_split[0]]
-            instruction = dst_split[1]
+        jmp = "000"
+    comp = instr_table[normalize_comp(instruction, text)]
+    return int("111" + comp + dst + jmp, 2)
+
+# Generated code repeats a few hundred distinct C-instructions, so each raw
+# text is validated and encoded once. encode_c.cache_info() has the counts.
+encode_c = functools.lru_cache(maxsize = 4096)(compile_c)
+
+def rewind(lines):
+    # Files are read twice; one-shot iterators have to be materialized.
+    if hasattr(lines, "seek"):
+        lines.seek(0)
+    elif iter(lines) is lines:
+        lines = list(lines)
+    return lines
+
+# Second pass: stream 16-bit words, allocating variables on first use.
+def assemble(lines):
+    lines = rewind(lines)
+    symbols = dict(symbol_table)
+    symbols.update(find_labels(lines))
+    lines = rewind(lines)
+    cur_register = 16
+    for line in lines:
+        instruction = strip_comment(line)
+        if instruction == "" or instruction[0] == '(':
+            continue
+        if instruction[0] == "@":
+            symbol = instruction[1:]
+            if symbol[0].isdigit():
+                yield int(symbol)
+            else:
+                if symbol not in symbols:
+                    symbols[symbol] = cur_register
+                    cur_register += 1
+                yield symbols[symbol]
         else:
-            dst = "000"
-        # calculation part is always populated
-        jump_split = instruction.split(";")
-        if len(jump_split) > 1:
-            jmp = jump_table[jump_split[1]]
-            instruction = jump_split[0]
+            yield encode_c(instruction)
+
+def output_filename(input_file, binary = False):
+    return input_file.rsplit(".", 1)[0] + (".rom" if binary else ".hack")
+
+def assemble_file(input_file, output_file = None, binary = False):
+    if output_file is None:
+        output_file = output_filename(input_file, binary)
+    with open(input_file, 'r') as f:
+        if binary:
+            write_rom(assemble(f), output_file)
         else:
-            jmp = "000"
-        output.write("111" + instr_table[instruction] + dst + jmp + "\n")
-            
+            with open(output_file, 'w') as out:
+                write_hack(assemble(f), out)
+    return output_file
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--binary", action = "store_true",
+                        help = "write a packed .rom image instead of .hack text")
+    parser.add_argument("--stats", action = "store_true",
+                        help = "report C-instruction encoder cache hits")
+    args = parser.parse_args()
+    assemble_file(args.input, args.output, args.binary)
+    if args.stats:
+        info = encode_c.cache_info()
+        print("C-instruction cache: {0} hits, {1} misses, {2} distinct"
+              .format(info.hits, info.misses, info.currsize))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# Hack computer emulator following projects/05/CPU.hdl and Computer.hdl.
+# ROM words are decoded once at load time; the run loop then only indexes
+# the decoded table and a flat RAM list. BlockComputer adds a second tier
+# that compiles hot basic blocks into Python functions.
+import argparse, time
+import hack_rom
+
+ROM_SIZE = 0x8000
+RAM_SIZE = 0x8000
+SCREEN   = 0x4000
+KBD      = 0x6000
+ADDRESS  = 0x7FFF               # addressM and pc are 15 bits wide
+MASK     = 0xFFFF
+
+# ALU computations of the documented zx nx zy ny f no control bits,
+# with x = D and y = A or M.
+computations = { 0b101010 : lambda x, y : 0,
+                 0b111111 : lambda x, y : 1,
+                 0b111010 : lambda x, y : MASK,
+                 0b001100 : lambda x, y : x,
+                 0b110000 : lambda x, y : y,
+                 0b001101 : lambda x, y : x ^ MASK,
+                 0b110001 : lambda x, y : y ^ MASK,
+                 0b001111 : lambda x, y : -x & MASK,
+                 0b110011 : lambda x, y : -y & MASK,
+                 0b011111 : lambda x, y : (x + 1) & MASK,
+                 0b110111 : lambda x, y : (y + 1) & MASK,
+                 0b001110 : lambda x, y : (x - 1) & MASK,
+                 0b110010 : lambda x, y : (y - 1) & MASK,
+                 0b000010 : lambda x, y : (x + y) & MASK,
+                 0b010011 : lambda x, y : (x - y) & MASK,
+                 0b000111 : lambda x, y : (y - x) & MASK,
+                 0b000000 : lambda x, y : x & y,
+                 0b010101 : lambda x, y : x | y }
+
+# Any other bit pattern goes through the ALU gate by gate.
+def alu(control):
+    zx, nx, zy, ny, f, no = [(control >> bit) & 1 for bit in range(5, -1, -1)]
+    def compute(x, y):
+        if zx: x = 0
+        if nx: x ^= MASK
+        if zy: y = 0
+        if ny: y ^= MASK
+        out = (x + y) & MASK if f else x & y
+        return out ^ MASK if no else out
+    return compute
+
+# Jump bits -> should we jump, indexed by the sign class of the ALU output:
+# 0 for zero, 1 for positive, 2 for negative.
+jumps = [ None ] + [ ((j & 2) != 0, (j & 1) != 0, (j & 4) != 0)
+                     for j in range(1, 8) ]
+
+def sign_class(value):
+    if value == 0:
+        return 0
+    return 2 if value & 0x8000 else 1
+
+A_INSTR = 0
+C_INSTR_A = 1                   # y operand is the A register
+C_INSTR_M = 2                   # y operand is RAM[A]
+HALT = 3                        # (L) @L 0;JMP: the program stopped
+
+def decode(word):
+    if not word & 0x8000:
+        return (A_INSTR, word, 0, None)
+    control = (word >> 6) & 0x3F
+    comp = computations.get(control) or alu(control)
+    kind = C_INSTR_M if word & 0x1000 else C_INSTR_A
+    return (kind, comp, (word >> 3) & 7, jumps[word & 7])
+
+def is_halt(words, pc):
+    if pc + 1 >= len(words):
+        return False
+    jump = words[pc + 1]
+    # @pc followed by an unconditional jump that stores nothing
+    return words[pc] == pc and (jump & 0x8000) != 0 and (jump & 0x3F) == 0b111
+
+class Computer:
+    def __init__(self, words = ()):
+        self.ram = [0] * RAM_SIZE
+        self.load(words)
+
+    def load(self, words):
+        words = list(words)
+        if len(words) > ROM_SIZE:
+            raise Exception("Program does not fit in ROM: " + \
+                            str(len(words)) + " words")
+        self.words = words
+        self.program = [ (HALT, pc, 0, None) if is_halt(words, pc)
+                         else decode(word) for pc, word in enumerate(words) ]
+        # Running past the end of the program (or wrapping around the
+        # 15-bit pc) also counts as stopping.
+        self.program += [ (HALT, 0, 0, None) ] * (ROM_SIZE + 1 - len(words))
+        self.reset()
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def set_keyboard(self, key):
+        self.ram[KBD] = key
+
+    def peek(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def poke(self, address, value):
+        self.ram[address] = value & MASK
+
+    # Runs at most `cycles` instructions; returns how many were executed.
+    def run(self, cycles):
+        if self.halted:
+            return 0
+        program = self.program
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        n = 0
+        while n < cycles:
+            kind, comp, dest, jump = program[pc]
+            n += 1
+            if kind == A_INSTR:
+                a = comp
+                pc += 1
+                continue
+            if kind == HALT:
+                a = comp
+                self.halted = True
+                break
+            value = comp(d, ram[a & ADDRESS] if kind == C_INSTR_M else a)
+            if jump is not None and jump[sign_class(value)]:
+                next_pc = a & ADDRESS
+            else:
+                next_pc = pc + 1
+            if dest:
+                if dest & 1:
+                    ram[a & ADDRESS] = value
+                if dest & 2:
+                    d = value
+                if dest & 4:
+                    a = value
+            pc = next_pc
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += n
+        return n
+
+    # Runs until the program reaches its final infinite loop.
+    def run_until_halt(self, max_cycles = None, slice_cycles = 1000000):
+        start = self.cycles
+        while not self.halted:
+            budget = slice_cycles
+            if max_cycles is not None:
+                budget = min(budget, max_cycles - (self.cycles - start))
+                if budget <= 0:
+                    break
+            self.run(budget)
+        return self.cycles - start
+
+# Python expressions for the computations, used by the block compiler.
+expressions = { 0b101010 : "0",
+                0b111111 : "1",
+                0b111010 : "65535",
+                0b001100 : "{x}",
+                0b110000 : "{y}",
+                0b001101 : "{x} ^ 65535",
+                0b110001 : "{y} ^ 65535",
+                0b001111 : "-{x} & 65535",
+                0b110011 : "-{y} & 65535",
+                0b011111 : "({x} + 1) & 65535",
+                0b110111 : "({y} + 1) & 65535",
+                0b001110 : "({x} - 1) & 65535",
+                0b110010 : "({y} - 1) & 65535",
+                0b000010 : "({x} + {y}) & 65535",
+                0b010011 : "({x} - {y}) & 65535",
+                0b000111 : "({y} - {x}) & 65535",
+                0b000000 : "{x} & {y}",
+                0b010101 : "{x} | {y}" }
+
+conditions = { 1 : "0 < v < 32768",
+               2 : "v == 0",
+               3 : "v < 32768",
+               4 : "v > 32767",
+               5 : "v != 0",
+               6 : "v == 0 or v > 32767",
+               7 : "True" }
+
+MAX_BLOCK = 256
+
+def is_jump(word):
+    return (word & 0x8000) != 0 and (word & 7) != 0
+
+# Static block boundaries: targets of @X followed by a jump, and the
+# instruction after every jump.
+def find_leaders(words):
+    leaders = { 0 }
+    for pc, word in enumerate(words):
+        if is_jump(word):
+            leaders.add(pc + 1)
+            if pc > 0 and not words[pc - 1] & 0x8000:
+                leaders.add(words[pc - 1])
+    return leaders
+
+# Generates `def block(ram, a, d)` running words[start:start + length] and
+# returning (pc, a, d). A is tracked at compile time after @X, so M becomes
+# ram[X] and A is only stored when it leaves the block.
+def compile_block(words, start, length):
+    namespace = {}
+    lines = [ "def block(ram, a, d):" ]
+    known = None
+    for pc in range(start, start + length):
+        word = words[pc]
+        if not word & 0x8000:
+            known = word
+            continue
+        control = (word >> 6) & 0x3F
+        if control not in expressions:
+            namespace["alu" + str(control)] = alu(control)
+        template = expressions.get(control, "alu" + str(control) + "({x}, {y})")
+        if known is None:
+            address = "a & 32767"
+            y = "ram[a & 32767]" if word & 0x1000 else "a"
+        else:
+            address = str(known & ADDRESS)
+            y = "ram[" + address + "]" if word & 0x1000 else str(known)
+        value = template.format(x = "d", y = y)
+        dest = (word >> 3) & 7
+        # Chained assignment stores left to right: M (through the old A),
+        # then D, then A.
+        targets = [ target for bit, target in
+                    [ (1, "ram[" + address + "]"), (2, "d"), (4, "a") ]
+                    if dest & bit ]
+        jump = word & 7
+        if jump:
+            target = address
+            if known is None and dest & 4:
+                lines.append("    t = a & 32767")
+                target = "t"
+            lines.append("    v = " + value)
+            targets.append("v")
+            value = "v"
+        if targets:
+            lines.append("    " + " = ".join(targets) + " = " + value)
+        if dest & 4:
+            known = None
+        a = "a" if known is None else str(known)
+        if jump == 7:
+            lines.append("    return " + target + ", " + a + ", d")
+            break
+        if jump:
+            lines.append("    if " + conditions[jump] + ":")
+            lines.append("        return " + target + ", " + a + ", d")
+    else:
+        a = "a" if known is None else str(known)
+        lines.append("    return " + str(start + length) + ", " + a + ", d")
+    exec(compile("\n".join(lines), "<block " + str(start) + ">", "exec"),
+         namespace)
+    return namespace["block"]
+
+class BlockComputer(Computer):
+    hot = 16                    # entries before a block gets compiled
+
+    def load(self, words):
+        Computer.load(self, words)
+        self.leaders = find_leaders(self.words)
+        self.blocks = [ None ] * len(self.program) # pc -> (function, length)
+        self.entries = {}       # entry pc -> times entered while cold
+        self.extents = {}
+
+    # Number of instructions from pc up to and including the next jump,
+    # stopping before a leader, a halt or the block size limit.
+    def extent(self, start):
+        if self.program[start][0] == HALT:
+            return 1
+        words = self.words
+        pc = start
+        while True:
+            word = words[pc]
+            pc += 1
+            if is_jump(word) or pc - start >= MAX_BLOCK or \
+               pc in self.leaders or self.program[pc][0] == HALT:
+                return pc - start
+
+    def enter(self, pc):
+        length = self.extents.get(pc)
+        if length is None:
+            length = self.extents[pc] = self.extent(pc)
+        count = self.entries.get(pc, 0) + 1
+        self.entries[pc] = count
+        if count < self.hot or self.program[pc][0] == HALT:
+            return (None, length)
+        block = (compile_block(self.words, pc, length), length)
+        self.blocks[pc] = block
+        return block
+
+    # Like Computer.run: compiled blocks run whole when they fit in the
+    # remaining budget, everything else goes through the interpreter.
+    def run(self, cycles):
+        blocks = self.blocks
+        ram = self.ram
+        n = 0
+        while n < cycles and not self.halted:
+            # Fast path: chain compiled blocks while any of them fits.
+            a, d, pc = self.a, self.d, self.pc
+            start = n
+            safe = cycles - MAX_BLOCK
+            while n <= safe:
+                block = blocks[pc]
+                if block is None:
+                    break
+                pc, a, d = block[0](ram, a, d)
+                n += block[1]
+            self.a, self.d, self.pc = a, d, pc
+            self.cycles += n - start
+            if n >= cycles:
+                break
+            # Slow path: a cold block, or close to the end of the budget.
+            function, length = blocks[pc] or self.enter(pc)
+            if function is not None and length <= cycles - n:
+                self.pc, self.a, self.d = function(ram, a, d)
+                self.cycles += length
+                n += length
+            else:
+                n += Computer.run(self, min(length, cycles - n))
+        return n
+
+def parse_assignment(text):
+    address, value = text.split("=")
+    return (int(address), int(value))
+
+def parse_range(text):
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help = ".hack or .rom file")
+    parser.add_argument("--cycles", type = int,
+                        help = "run this many cycles instead of until halt")
+    parser.add_argument("--set", action = "append", default = [],
+                        type = parse_assignment, metavar = "ADDR=VALUE")
+    parser.add_argument("--show", action = "append", default = [],
+                        type = parse_range, metavar = "ADDR[-ADDR]")
+    parser.add_argument("--blocks", action = "store_true",
+                        help = "compile hot basic blocks to Python")
+    args = parser.parse_args()
+    machine = BlockComputer if args.blocks else Computer
+    computer = machine(hack_rom.load(args.input))
+    for address, value in args.set:
+        computer.poke(address, value)
+    start = time.perf_counter()
+    if args.cycles is None:
+        cycles = computer.run_until_halt()
+    else:
+        cycles = computer.run(args.cycles)
+    elapsed = time.perf_counter() - start
+    print("{0} cycles in {1:.3f}s ({2:.0f} cycles/s){3}".format(
+        cycles, elapsed, cycles / elapsed if elapsed else 0,
+        ", halted" if computer.halted else ""))
+    for addresses in args.show:
+        for address in addresses:
+            print("RAM[{0}] = {1}".format(address, computer.peek(address)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Hack ROM images in two formats:
+#   .hack - text, one line of 16 '0'/'1' characters per word
+#   .rom  - binary, a 12 byte header followed by little-endian uint16 words
+# The binary header is: magic "HACK", uint16 version, uint16 reserved (0),
+# uint32 word count. Words start at byte 12, so the payload can be mapped
+# directly, e.g. numpy.memmap(path, dtype="<u2", offset=HEADER.size).
+import argparse, array, itertools, mmap, struct, sys
+
+MAGIC = b"HACK"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+
+def is_rom_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def to_array(words):
+    words = array.array('H', words)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+def write_rom(words, output_file):
+    words = to_array(words)
+    with open(output_file, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, VERSION, 0, len(words)))
+        words.tofile(out)
+
+def read_header(data, filename):
+    if len(data) < HEADER.size:
+        raise Exception("Truncated ROM header in " + filename)
+    magic, version, _, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not a version " + str(VERSION) + " Hack ROM: " + filename)
+    if len(data) < HEADER.size + 2 * count:
+        raise Exception("Truncated ROM payload in " + filename)
+    return count
+
+def read_rom(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    count = read_header(data, filename)
+    words = array.array('H')
+    words.frombytes(data[HEADER.size:HEADER.size + 2 * count])
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+# Zero-copy view of the words. The view keeps the mapping alive.
+def map_rom(filename):
+    if sys.byteorder == "big":
+        return memoryview(read_rom(filename))
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    count = read_header(data, filename)
+    return memoryview(data)[HEADER.size:HEADER.size + 2 * count].cast('H')
+
+def load_numpy(filename):
+    import numpy
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    count = read_header(data, filename)
+    data.close()
+    return numpy.memmap(filename, dtype = "<u2", mode = 'r',
+                        offset = HEADER.size, shape = (count,))
+
+def read_hack(filename):
+    with open(filename, 'r') as f:
+        return array.array('H', [int(line, 2) for line in f if line.strip()])
+
+def write_hack(words, out, chunk_size = 4096):
+    words = iter(words)
+    while True:
+        chunk = list(itertools.islice(words, chunk_size))
+        if not chunk:
+            break
+        out.write("".join(["{0:016b}\n".format(w) for w in chunk]))
+
+# Words of a ROM image in either format.
+def load(filename):
+    if is_rom_file(filename):
+        return read_rom(filename)
+    return read_hack(filename)
+
+def hack_to_rom(input_file, output_file):
+    write_rom(read_hack(input_file), output_file)
+
+def rom_to_hack(input_file, output_file):
+    with open(output_file, 'w') as out:
+        write_hack(read_rom(input_file), out)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help = ".hack or .rom file")
+    parser.add_argument("-o", "--output")
+    args = parser.parse_args()
+    to_text = is_rom_file(args.input)
+    output_file = args.output
+    if output_file is None:
+        output_file = args.input.rsplit(".", 1)[0] + \
+                      (".hack" if to_text else ".rom")
+    if to_text:
+        rom_to_hack(args.input, output_file)
+    else:
+        hack_to_rom(args.input, output_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Peephole optimizer for Hack assembly. It runs between a code generator
+# (e.g. vm_to_hack.py) and the assembler: a window slides over the
+# instructions and the first rule of the rule table that matches rewrites
+# it. Labels are barriers, since control can enter there from elsewhere, so
+# no window spans one (except the jump-to-next-label rule, which ends on it).
+import argparse
+
+def strip_comment(line):
+  comment = line.find("//")
+  if comment != -1:
+    line = line[:comment]
+  return line.strip()
+
+def is_label(line):
+  return line.startswith("(")
+
+def is_a(line):
+  return line.startswith("@")
+
+# (dest, comp, jump) of a C instruction.
+def fields(line):
+  dest, _, rest = line.rpartition("=")
+  comp, _, jump = rest.partition(";")
+  return (dest, comp, jump)
+
+def is_c(line):
+  return not is_label(line) and not is_a(line)
+
+def writes_a(line):
+  return "A" in fields(line)[0]
+
+def sets_d(line):
+  dest, comp, _ = fields(line)
+  return "D" in dest and "D" not in comp
+
+# Only D is written and nothing jumps, so it can go if D is dead.
+def loads_d(line):
+  dest, _, jump = fields(line)
+  return dest == "D" and jump == ""
+
+def is_goto(line):
+  dest, comp, jump = fields(line)
+  return dest == "" and jump == "JMP"
+
+# Each rule takes a window of instructions and returns its replacement,
+# or None if it does not apply.
+
+# A push immediately popped again: only A = SP is left.
+def push_pop(window):
+  if window == ["@SP", "M=M+1", "@SP", "AM=M-1"]:
+    return ["@SP", "A=M"]
+
+# @X <instruction that keeps A> @X: A already holds X.
+def reload_a(window):
+  first, middle, last = window
+  if is_a(first) and first == last and is_c(middle) and \
+     not writes_a(middle):
+    return [first, middle]
+
+def dead_d(window):
+  first, second = window
+  if is_c(first) and loads_d(first) and is_c(second) and sets_d(second):
+    return [second]
+
+def dead_d_across_a(window):
+  first, second, third = window
+  if is_c(first) and loads_d(first) and is_a(second) and \
+     is_c(third) and sets_d(third):
+    return [second, third]
+
+# @X @Y: the first load is overwritten unused.
+def dead_a(window):
+  first, second = window
+  if is_a(first) and is_a(second):
+    return [second]
+
+# @L <jump> (L): both ways end at L.
+def jump_to_next(window):
+  target, jump, label = window
+  if is_a(target) and is_c(jump) and fields(jump)[0] == "" and \
+     fields(jump)[2] != "" and label == "(" + target[1:] + ")":
+    return [label]
+
+# Nothing after an unconditional jump runs until the next label.
+def unreachable(window):
+  jump, dead = window
+  if is_c(jump) and is_goto(jump):
+    return [jump]
+
+rules = [ ("push-pop",      4, push_pop),
+          ("jump-to-next",  3, jump_to_next),
+          ("reload-a",      3, reload_a),
+          ("dead-d",        2, dead_d),
+          ("dead-d-over-a", 3, dead_d_across_a),
+          ("dead-a",        2, dead_a),
+          ("unreachable",   2, unreachable) ]
+
+longest_rule = max([ size for _, size, _ in rules ])
+
+def match(lines, i, size):
+  window = lines[i:i + size]
+  if len(window) < size:
+    return None
+  # A label may only end the window of a rule that expects one there.
+  if any([ is_label(line) for line in window[:-1] ]):
+    return None
+  return window
+
+# Returns the optimized instructions (comments and blank lines stripped)
+# and the number of times each rule fired.
+def optimize(lines, rules = rules):
+  lines = [ strip_comment(line) for line in lines ]
+  lines = [ line for line in lines if line != "" ]
+  hits = dict([ (name, 0) for name, _, _ in rules ])
+  i = 0
+  while i < len(lines):
+    for name, size, rule in rules:
+      window = match(lines, i, size)
+      if window is None:
+        continue
+      if is_label(window[-1]) and rule is not jump_to_next:
+        continue
+      replacement = rule(window)
+      if replacement is not None:
+        lines[i:i + size] = replacement
+        hits[name] += 1
+        # The rewrite may complete a pattern that starts a little earlier.
+        i = max(0, i - longest_rule)
+        break
+    else:
+      i += 1
+  return (lines, hits)
+
+def optimize_text(asm, rules = rules):
+  lines, hits = optimize(asm.split("\n"), rules)
+  return ("".join([ line + "\n" for line in lines ]), hits)
+
+def print_hits(hits):
+  for name, _, _ in rules:
+    if name in hits:
+      print("  {0:14} {1}".format(name, hits[name]))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input", help = ".asm file")
+  parser.add_argument("-o", "--output",
+                      help = "output file (default: rewrite the input)")
+  args = parser.parse_args()
+  with open(args.input, 'r') as f:
+    lines = [ strip_comment(line) for line in f ]
+  before = len([ line for line in lines
+                 if line != "" and not is_label(line) ])
+  lines, hits = optimize(lines)
+  after = len([ line for line in lines if not is_label(line) ])
+  with open(args.output or args.input, 'w') as out:
+    out.write("".join([ line + "\n" for line in lines ]))
+  print("ROM size: ", before, "->", after, "words")
+  print_hits(hits)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Headless runner for the CPU emulator test scripts of projects 07 and 08.
+# The .vm sources are translated and assembled in process, run on the Hack
+# emulator from projects/06, and the output is compared with the .cmp file.
+import argparse, os, re, sys
+from concurrent.futures import ProcessPoolExecutor
+from vm_to_hack import translate_files, is_vm_file
+import peephole
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "06"))
+from assembler import assemble
+from emulator import Computer, BlockComputer
+
+script_tokens = re.compile(r"//[^\n]*|/\*.*?\*/|([{},;])|([^\s{},;]+)", re.S)
+
+# A script is a list of commands. A command is a list of words; repeat
+# blocks carry their body as the last element: ["repeat", "350", [...]].
+def parse_script(text):
+  script = []
+  stack = []
+  command = []
+  for match in script_tokens.finditer(text):
+    separator, word = match.groups()
+    if word is not None:
+      command.append(word)
+      continue
+    if separator is None:       # a comment
+      continue
+    if separator == "{":
+      stack.append((script, command))
+      script = []
+    else:
+      if command:
+        script.append(command)
+      if separator == "}":
+        body = script
+        script, command = stack.pop()
+        script.append(command + [body])
+    command = []
+  if stack:
+    raise Exception("Unterminated repeat block")
+  if command:
+    script.append(command)
+  return script
+
+column_format = re.compile(r"(.+)%([BDXS])(\d+)\.(\d+)\.(\d+)$")
+
+def parse_column(text):
+  match = column_format.match(text)
+  if match is None:
+    raise Exception("Bad output-list entry: " + text)
+  name, base, left, width, right = match.groups()
+  return (name, base, int(left), int(width), int(right))
+
+def header(columns):
+  out = "|"
+  for name, _, left, width, right in columns:
+    size = left + width + right
+    name = name[:size]
+    space = size - len(name)
+    out += " " * (space // 2) + name + " " * (space - space // 2) + "|"
+  return out
+
+ram_cell = re.compile(r"RAM(?:16K)?\[(\d+)\]$")
+
+def read_value(computer, name):
+  match = ram_cell.match(name)
+  if match:
+    return computer.ram[int(match.group(1))]
+  if name in ("PC", "PC[]"):
+    return computer.pc
+  if name in ("A", "ARegister[]"):
+    return computer.a
+  if name in ("D", "DRegister[]"):
+    return computer.d
+  if name == "time":
+    return computer.cycles
+  raise Exception("Unknown variable: " + name)
+
+def format_value(value, base, width):
+  if base == "D" or base == "S":
+    text = str(value - 0x10000 if value & 0x8000 else value)
+  elif base == "X":
+    text = "{0:04X}".format(value)
+  else:
+    text = "{0:016b}".format(value)
+  return text[-width:].rjust(width)
+
+def row(computer, columns):
+  out = "|"
+  for name, base, left, width, right in columns:
+    value = read_value(computer, name)
+    out += " " * left + format_value(value, base, width) + " " * right + "|"
+  return out
+
+def write_value(computer, name, value):
+  match = ram_cell.match(name)
+  if match:
+    computer.poke(int(match.group(1)), value)
+  elif name in ("PC", "PC[]"):
+    computer.pc = value
+  elif name in ("A", "ARegister[]"):
+    computer.a = value & 0xFFFF
+  elif name in ("D", "DRegister[]"):
+    computer.d = value & 0xFFFF
+  else:
+    raise Exception("Unknown variable: " + name)
+
+# X.asm comes from X.vm if there is one, otherwise from every .vm file in
+# the directory plus the bootstrap code, exactly like vm_to_hack.py.
+def load_program(directory, asm_file, options):
+  vm_file = os.path.join(directory, asm_file[:-4] + ".vm")
+  if os.path.isfile(vm_file):
+    vm_files, write_bootstrap = [vm_file], False
+  else:
+    vm_files = [ os.path.join(directory, f)
+                 for f in sorted(os.listdir(directory)) if is_vm_file(f) ]
+    write_bootstrap = True
+  options = dict(options)
+  use_peephole = options.pop("peephole", False)
+  asm = "".join(translate_files(vm_files, write_bootstrap, **options))
+  if use_peephole:
+    asm, _ = peephole.optimize_text(asm)
+  return list(assemble(asm.splitlines()))
+
+class ScriptRun:
+  def __init__(self, tst_file, machine, options):
+    self.directory = os.path.dirname(tst_file)
+    self.machine = machine
+    self.options = options
+    self.computer = None
+    self.columns = []
+    self.lines = []
+    self.output_file = None
+    self.compare_file = None
+
+  def execute(self, script):
+    for command in script:
+      name = command[0]
+      if name == "load":
+        self.computer = self.machine(
+          load_program(self.directory, command[1], self.options))
+      elif name == "output-file":
+        self.output_file = os.path.join(self.directory, command[1])
+      elif name == "compare-to":
+        self.compare_file = os.path.join(self.directory, command[1])
+      elif name == "output-list":
+        self.columns = [ parse_column(c) for c in command[1:] ]
+        self.lines.append(header(self.columns))
+      elif name == "set":
+        write_value(self.computer, command[1], int(command[2]))
+      elif name == "output":
+        self.lines.append(row(self.computer, self.columns))
+      elif name == "ticktock":
+        self.computer.run(1)
+      elif name == "repeat":
+        count, body = int(command[1]), command[2]
+        if body == [ ["ticktock"] ]:
+          self.computer.run(count)
+        else:
+          for _ in range(count):
+            self.execute(body)
+      elif name == "echo":
+        pass
+      else:
+        raise Exception("Unsupported test script command: " + name)
+
+# Returns (tst_file, passed, messages). options go to translate_files.
+def run_test(tst_file, blocks = False, write_out = False, options = {}):
+  with open(tst_file, 'r') as f:
+    script = parse_script(f.read())
+  run = ScriptRun(tst_file, BlockComputer if blocks else Computer, options)
+  run.execute(script)
+  if write_out and run.output_file:
+    with open(run.output_file, 'w', newline = "") as out:
+      out.write("".join([ line + "\r\n" for line in run.lines ]))
+  if run.compare_file is None:
+    return (tst_file, True, [])
+  with open(run.compare_file, 'r') as f:
+    expected = [ line.rstrip("\r\n") for line in f if line.strip() ]
+  messages = []
+  for i in range(max(len(expected), len(run.lines))):
+    want = expected[i] if i < len(expected) else "<missing>"
+    got = run.lines[i] if i < len(run.lines) else "<missing>"
+    if want != got:
+      messages.append("line " + str(i + 1) + ": expected " + want)
+      messages.append("line " + str(i + 1) + ":      got " + got)
+  return (tst_file, not messages, messages)
+
+def run_test_safely(args):
+  try:
+    return run_test(*args)
+  except Exception as e:
+    return (args[0], False, [ "error: " + str(e) ])
+
+# Emulator scripts only; the VME variants are for the VM emulator.
+def find_tests(paths):
+  out = []
+  for path in paths:
+    if os.path.isfile(path):
+      out.append(path)
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for f in sorted(files):
+        if f.endswith(".tst") and not f.endswith("VME.tst"):
+          out.append(os.path.join(root, f))
+  return out
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("paths", nargs = "+", help = ".tst files or directories")
+  parser.add_argument("--jobs", type = int, default = os.cpu_count())
+  parser.add_argument("--blocks", action = "store_true",
+                      help = "use the basic-block emulator tier")
+  parser.add_argument("--write-out", action = "store_true",
+                      help = "write the .out files named by the scripts")
+  parser.add_argument("-O", "--optimize", action = "count", default = 0,
+                      help = "translate with vm_to_hack -O (or -OO)")
+  parser.add_argument("-S", "--shared", action = "store_true",
+                      help = "translate with vm_to_hack -S")
+  parser.add_argument("-E", "--eliminate-dead", action = "store_true",
+                      help = "translate with vm_to_hack -E")
+  parser.add_argument("-P", "--peephole", action = "store_true",
+                      help = "translate with vm_to_hack -P")
+  args = parser.parse_args()
+  options = { "optimize" : args.optimize, "shared" : args.shared,
+              "eliminate" : args.eliminate_dead, "peephole" : args.peephole }
+  tests = [ (t, args.blocks, args.write_out, options)
+            for t in find_tests(args.paths) ]
+  with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+    results = list(pool.map(run_test_safely, tests))
+  failed = 0
+  for tst_file, passed, messages in results:
+    print(("PASS " if passed else "FAIL ") + tst_file)
+    for message in messages:
+      print("  " + message)
+    failed += not passed
+  print(str(len(results) - failed) + " passed, " + str(failed) + " failed")
+  sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+  main()
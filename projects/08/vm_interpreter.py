@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Runs .vm programs directly, one VM command per step, instead of
+# translating them to Hack assembly and emulating the CPU. Labels, function
+# names and static variables are resolved to integers when the program is
+# loaded; the stack and the segments live in a 32K-word RAM laid out as
+# on the Hack platform (SP, LCL, ARG, THIS, THAT in RAM[0..4], temp at 5,
+# statics from 16), so screen and keyboard memory work as usual.
+# Every step is counted per command, which gives a per-function profile.
+# lt and gt test the sign of x - y like the translated code does, so
+# results agree with vm_to_hack.py even where the difference overflows.
+import argparse, time
+from vm_to_hack import get_filenames, load_programs, split_functions
+
+RAM_SIZE = 0x8000
+MASK = 0xFFFF
+SP, LCL, ARG, THIS, THAT = range(5)
+
+(PUSH_CONSTANT, PUSH_DIRECT, PUSH_INDIRECT, POP_DIRECT, POP_INDIRECT,
+ ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ LABEL, GOTO, IF_GOTO, FUNCTION, CALL, RETURN, HALT) = range(21)
+
+arithmetic = { "add" : ADD,
+               "sub" : SUB,
+               "neg" : NEG,
+               "eq"  : EQ,
+               "gt"  : GT,
+               "lt"  : LT,
+               "and" : AND,
+               "or"  : OR,
+               "not" : NOT }
+
+pointers = { "local"    : LCL,
+             "argument" : ARG,
+             "this"     : THIS,
+             "that"     : THAT }
+
+direct = { "temp" : 5,
+           "pointer" : 3 }
+
+class Program:
+  def __init__(self, programs):
+    self.statics = {}
+    self.functions = []         # (name, first command, end)
+    self.commands = []          # (filename, function, words)
+    for filename, instructions in programs:
+      for name, body in split_functions(instructions):
+        start = len(self.commands)
+        self.commands += [ (filename, name, i.split()) for i in body ]
+        self.functions.append((name, start, len(self.commands)))
+    self.entries = dict([ (name, start) for name, start, _ in self.functions
+                          if name is not None ])
+    self.labels = {}
+    for pc, (_, function, words) in enumerate(self.commands):
+      if words[0] == "label":
+        self.labels[(function, words[1])] = pc
+    self.code = [ self.decode(pc) for pc in range(len(self.commands)) ]
+    # Returning past the end (e.g. to a fake return address) halts.
+    self.code.append((HALT, 0, 0))
+
+  def static(self, filename, index):
+    key = filename + index
+    if key not in self.statics:
+      self.statics[key] = 16 + len(self.statics)
+    return self.statics[key]
+
+  def address(self, filename, segment, index):
+    if segment == "static":
+      return self.static(filename, index)
+    return direct[segment] + int(index)
+
+  def target(self, function, label):
+    if (function, label) not in self.labels:
+      raise Exception("Undefined label: " + label)
+    return self.labels[(function, label)]
+
+  def decode(self, pc):
+    filename, function, words = self.commands[pc]
+    command = words[0]
+    if command in arithmetic and len(words) == 1:
+      return (arithmetic[command], 0, 0)
+    if command == "push" and words[1] == "constant":
+      return (PUSH_CONSTANT, int(words[2]), 0)
+    if command in ("push", "pop") and words[1] in pointers:
+      return (PUSH_INDIRECT if command == "push" else POP_INDIRECT,
+              pointers[words[1]], int(words[2]))
+    if command in ("push", "pop"):
+      return (PUSH_DIRECT if command == "push" else POP_DIRECT,
+              self.address(filename, words[1], words[2]), 0)
+    if command == "label":
+      return (LABEL, 0, 0)
+    if command == "goto":
+      target = self.target(function, words[1])
+      # "label L, goto L" (or a goto to itself) is the final loop.
+      if target == pc - 1 or target == pc:
+        return (HALT, 0, 0)
+      return (GOTO, target, 0)
+    if command == "if-goto":
+      return (IF_GOTO, self.target(function, words[1]), 0)
+    if command == "function":
+      return (FUNCTION, int(words[2]), 0)
+    if command == "call":
+      if words[1] not in self.entries:
+        raise Exception("Undefined function: " + words[1])
+      return (CALL, self.entries[words[1]], int(words[2]))
+    if command == "return":
+      return (RETURN, 0, 0)
+    raise Exception("Unknown command: " + " ".join(words))
+
+class Machine:
+  def __init__(self, program, bootstrap = True):
+    self.program = program
+    self.ram = [0] * RAM_SIZE
+    self.counts = [0] * len(program.code)
+    self.reset(bootstrap)
+
+  # Like the translator's bootstrap code: SP = 256, call Sys.init. Its
+  # return address is the halt past the end of the program.
+  def reset(self, bootstrap = True):
+    self.pc = 0
+    self.steps = 0
+    self.halted = False
+    if bootstrap:
+      if "Sys.init" not in self.program.entries:
+        raise Exception("Undefined function: Sys.init")
+      self.ram[SP] = 261
+      self.ram[256:261] = [ len(self.program.code) - 1 ] + self.ram[LCL:5]
+      self.ram[ARG] = 256
+      self.ram[LCL] = 261
+      self.pc = self.program.entries["Sys.init"]
+
+  def peek(self, address):
+    value = self.ram[address]
+    return value - 0x10000 if value & 0x8000 else value
+
+  def poke(self, address, value):
+    self.ram[address] = value & MASK
+
+  # Runs at most `steps` commands; returns how many were executed. The
+  # stack pointer is held in a local while running.
+  def run(self, steps):
+    if self.halted:
+      return 0
+    code = self.program.code
+    end = len(code) - 1
+    counts = self.counts
+    ram = self.ram
+    pc = self.pc
+    sp = ram[SP]
+    n = 0
+    while n < steps:
+      op, x, y = code[pc]
+      counts[pc] += 1
+      n += 1
+      if op == PUSH_INDIRECT:
+        ram[sp] = ram[ram[x] + y]
+        sp += 1
+      elif op == PUSH_CONSTANT:
+        ram[sp] = x
+        sp += 1
+      elif op == PUSH_DIRECT:
+        ram[sp] = ram[x]
+        sp += 1
+      elif op == POP_INDIRECT:
+        sp -= 1
+        ram[ram[x] + y] = ram[sp]
+      elif op == POP_DIRECT:
+        sp -= 1
+        ram[x] = ram[sp]
+      elif op == ADD:
+        sp -= 1
+        ram[sp - 1] = (ram[sp - 1] + ram[sp]) & MASK
+      elif op == SUB:
+        sp -= 1
+        ram[sp - 1] = (ram[sp - 1] - ram[sp]) & MASK
+      elif op == IF_GOTO:
+        sp -= 1
+        if ram[sp]:
+          pc = x
+          continue
+      elif op == GOTO:
+        pc = x
+        continue
+      elif op == LABEL:
+        pass
+      elif op == LT:
+        sp -= 1
+        ram[sp - 1] = MASK if (ram[sp - 1] - ram[sp]) & 0x8000 else 0
+      elif op == GT:
+        sp -= 1
+        difference = (ram[sp - 1] - ram[sp]) & MASK
+        ram[sp - 1] = MASK if difference and not difference & 0x8000 else 0
+      elif op == EQ:
+        sp -= 1
+        ram[sp - 1] = MASK if ram[sp - 1] == ram[sp] else 0
+      elif op == NOT:
+        ram[sp - 1] ^= MASK
+      elif op == NEG:
+        ram[sp - 1] = -ram[sp - 1] & MASK
+      elif op == AND:
+        sp -= 1
+        ram[sp - 1] &= ram[sp]
+      elif op == OR:
+        sp -= 1
+        ram[sp - 1] |= ram[sp]
+      elif op == CALL:
+        ram[sp:sp + 5] = [ pc + 1, ram[LCL], ram[ARG], ram[THIS], ram[THAT] ]
+        ram[ARG] = sp - y
+        sp += 5
+        ram[LCL] = sp
+        pc = x
+        continue
+      elif op == FUNCTION:
+        ram[sp:sp + x] = [0] * x
+        sp += x
+      elif op == RETURN:
+        frame = ram[LCL]
+        # Read first: with no arguments *ARG is the return address.
+        pc = min(ram[frame - 5], end)
+        ram[ram[ARG]] = ram[sp - 1]
+        sp = ram[ARG] + 1
+        ram[LCL:5] = ram[frame - 4:frame]
+        continue
+      else:
+        self.halted = True
+        break
+      pc += 1
+    ram[SP] = sp
+    self.pc = pc
+    self.steps += n
+    return n
+
+  def run_until_halt(self, max_steps = None, slice_steps = 1000000):
+    start = self.steps
+    while not self.halted:
+      budget = slice_steps
+      if max_steps is not None:
+        budget = min(budget, max_steps - (self.steps - start))
+        if budget <= 0:
+          break
+      self.run(budget)
+    return self.steps - start
+
+  # (function, calls, steps) for every function that ran, busiest first.
+  # A function's first command runs once per call.
+  def profile(self):
+    out = []
+    for name, start, end in self.program.functions:
+      steps = sum(self.counts[start:end])
+      if steps:
+        calls = self.counts[start] if name is not None else 0
+        out.append((name or "(no function)", calls, steps))
+    return sorted(out, key = lambda row: -row[2])
+
+def parse_assignment(text):
+  address, value = text.split("=")
+  return (int(address), int(value))
+
+def parse_range(text):
+  first, _, last = text.partition("-")
+  return range(int(first), int(last or first) + 1)
+
+def print_profile(machine, top):
+  total = machine.steps or 1
+  print("{0:30} {1:>10} {2:>12} {3:>7}".format("function", "calls",
+                                               "steps", "%"))
+  for name, calls, steps in machine.profile()[:top]:
+    print("{0:30} {1:>10} {2:>12} {3:>6.1f}%".format(
+      name, calls, steps, 100.0 * steps / total))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input", help = ".vm file or directory")
+  parser.add_argument("--steps", type = int,
+                      help = "run this many commands instead of until halt")
+  parser.add_argument("--set", action = "append", default = [],
+                      type = parse_assignment, metavar = "ADDR=VALUE")
+  parser.add_argument("--show", action = "append", default = [],
+                      type = parse_range, metavar = "ADDR[-ADDR]")
+  parser.add_argument("--profile", type = int, nargs = "?", const = 20,
+                      metavar = "N", help = "show the N busiest functions")
+  args = parser.parse_args()
+  vm_files, _, bootstrap = get_filenames(args.input)
+  program = Program(load_programs(sorted(vm_files)))
+  machine = Machine(program, bootstrap)
+  for address, value in args.set:
+    machine.poke(address, value)
+  start = time.perf_counter()
+  if args.steps is None:
+    steps = machine.run_until_halt()
+  else:
+    steps = machine.run(args.steps)
+  elapsed = time.perf_counter() - start
+  print("{0} steps in {1:.3f}s ({2:.0f} steps/s){3}".format(
+    steps, elapsed, steps / elapsed if elapsed else 0,
+    ", halted" if machine.halted else ""))
+  for addresses in args.show:
+    for address in addresses:
+      print("RAM[{0}] = {1}".format(address, machine.peek(address)))
+  if args.profile:
+    print_profile(machine, args.profile)
+
+if __name__ == "__main__":
+  main()
@@ -1,4 +1,7 @@
-import argparse, os
+import argparse, hashlib, os, re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import peephole
 
 def strip_comment(line):
   comment = line.find("//")
@@ -29,35 +32,40 @@ direct = { "temp" : 5,
 def at_direct(segment, index):
   return ("@" + str(direct[segment] + int(index)))
 
-def push_command(segment, index, filename):
+def load_to_D(segment, index, filename):
   if segment == "constant":
-    out = "@" + index + """
+    return "@" + index + """
 D=A"""
   elif segment == "static":
-    out = "@" + filename + index + """
+    return "@" + filename + index + """
 D=M"""
   elif segment in direct:
-    out = at_direct(segment, index) + """
+    return at_direct(segment, index) + """
 D=M"""
   else:
-    out = "@" + index + """
+    return "@" + index + """
 D=A
 @""" + segments[segment] + """
 A=M+D
 D=M"""
-  # assume the value is in D now
-  return(out + """
+
+push_D = """
 @SP
 A=M
 M=D
 @SP
-M=M+1""")
+M=M+1"""
 
-def pop_command(segment, index, filename):
-  pop_to_D = """@SP
+def push_command(segment, index, filename):
+  # assume the value is in D now
+  return load_to_D(segment, index, filename) + push_D
+
+pop_to_D = """@SP
 AM=M-1
 D=M
 """
+
+def store_from_D(segment, index, filename):
   follow_ptr_and_store_D = """
 M=D"""
   if segment in direct:
@@ -77,33 +85,44 @@ M=D
 D=M
 @tmp1
 A=M"""
-  return pop_to_D + middle + follow_ptr_and_store_D
+  return middle + follow_ptr_and_store_D
 
+def pop_command(segment, index, filename):
+  return pop_to_D + store_from_D(segment, index, filename)
+
+# Generated labels are numbered per file and prefixed with the file's
+# namespace, so a file's code does not depend on what was translated before.
 counter = lambda : 1
+counter.prefix = ""
 counter.cur_jump = 0
 counter.cur_retaddr = 0
 
+def start_file(prefix):
+  counter.prefix = prefix
+  counter.cur_jump = 0
+  counter.cur_retaddr = 0
+
 jumps = { "eq" : "JEQ",
           "gt" : "JGT",
           "lt" : "JLT" }
 
-def comparison(f):
+def compare_to_D(f):
   jmp = str(counter.cur_jump)
   counter.cur_jump += 1
+  true_label = counter.prefix + "IFTRUE" + jmp
+  continue_label = counter.prefix + "CONTINUE" + jmp
   return """D=M-D
-@IFTRUE""" + jmp + """
+@""" + true_label + """
 D;""" + jumps[f] + """
 D=0
-@CONTINUE""" + jmp + """
+@""" + continue_label + """
 D;JMP
-(IFTRUE""" + jmp + """)
+(""" + true_label + """)
 D=-1
-(CONTINUE""" + jmp + """)
-@SP
-A=M
-M=D
-@SP
-M=M+1"""
+(""" + continue_label + ")"
+
+def comparison(f):
+  return compare_to_D(f) + push_D
 
 simple_functions = { "add" : "+",
                      "sub" : "-",
@@ -139,6 +158,31 @@ D=M
 @""" + label + """
 D;JNE"""
 
+# Fused "<comparison> [not] if-goto L" windows, see fuse_branches.
+branches = { "if-eq" : "JEQ",
+             "if-ne" : "JNE",
+             "if-gt" : "JGT",
+             "if-le" : "JLE",
+             "if-lt" : "JLT",
+             "if-ge" : "JGE" }
+
+negated = { "eq" : "ne",
+            "gt" : "le",
+            "lt" : "ge" }
+
+def compare_and_jump(branch, label):
+  return """D=M-D
+@""" + label + """
+D;""" + branches[branch]
+
+def branch(f, label):
+  return """@SP
+AM=M-1
+D=M
+@SP
+AM=M-1
+""" + compare_and_jump(f, label)
+
 def function(name, num_locals):
   return "(" + name + (")" if num_locals == 0 else """)
 @SP
@@ -161,7 +205,7 @@ M=D""".format(ptr, offset) for (ptr, offset)
                  # ("RET" , "5")
              ]])
 
-return_code = """// FRAME = LCL
+return_frame = """// FRAME = LCL
 @LCL
 D=M
 @frame
@@ -173,14 +217,9 @@ A=M-D
 D=M
 @RET
 M=D
-// *ARG = pop()
-@SP
-AM=M-1
-D=M
-@ARG
-A=M
-M=D
-// SP = ARG+1
+"""
+
+return_restore = """// SP = ARG+1
 @ARG
 D=M+1
 @SP
@@ -191,24 +230,46 @@ M=D
 A=M
 0;JMP"""
 
-def call(fun_name, num_args):
-  ret_addr = "RETURN_ADDRESS_" + str(counter.cur_retaddr)
-  counter.cur_retaddr += 1
-  return ("@" + ret_addr + """
-D=A
-@SP
+# The same, for a return value that is held in D rather than on the stack.
+return_from_D = """@R13
+M=D
+""" + return_frame + """// *ARG = return value
+@R13
+D=M
+@ARG
 A=M
 M=D
+""" + return_restore
+
+return_code = return_frame + """// *ARG = pop()
 @SP
-M=M+1
-""" + "\n".join(["// push " + ptr + """
+AM=M-1
+D=M
+@ARG
+A=M
+M=D
+""" + return_restore
+
+push_frame = "\n".join(["// push " + ptr + """
 @""" + ptr + """
 D=M
 @SP
 A=M
 M=D
 @SP
-M=M+1""" for ptr in ["LCL", "ARG", "THIS", "THAT"]]) + """
+M=M+1""" for ptr in ["LCL", "ARG", "THIS", "THAT"]])
+
+def call(fun_name, num_args):
+  ret_addr = counter.prefix + "RETURN_ADDRESS_" + str(counter.cur_retaddr)
+  counter.cur_retaddr += 1
+  return ("@" + ret_addr + """
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+""" + push_frame + """
 // ARG = SP-n-5
 @5
 D=A
@@ -229,9 +290,114 @@ M=D
 // (return-address)
 (""" + ret_addr + ")")
 
-def translate_instruction(instruction, filename):
-  out = [ "// " + instruction ]
-  instruction = instruction.split()
+# Size-optimized code: calls, returns and comparisons jump to a single
+# shared copy of their code ($$call, $$return, $$eq, ...) that is emitted
+# once per program. The return address is passed in D; $$call takes the
+# argument count in R14 and the function address in R15.
+def return_label():
+  ret_addr = counter.prefix + "RETURN_ADDRESS_" + str(counter.cur_retaddr)
+  counter.cur_retaddr += 1
+  return ret_addr
+
+def call_stub(fun_name, num_args, shared):
+  shared.add("$$call")
+  ret_addr = return_label()
+  return "@" + num_args + """
+D=A
+@R14
+M=D
+@""" + fun_name + """
+D=A
+@R15
+M=D
+@""" + ret_addr + """
+D=A
+@$$call
+0;JMP
+(""" + ret_addr + ")"
+
+def compare_stub(f, shared):
+  shared.add("$$" + f)
+  ret_addr = return_label()
+  return "@" + ret_addr + """
+D=A
+@$$""" + f + """
+0;JMP
+(""" + ret_addr + ")"
+
+def return_stub(routine, shared):
+  shared.add(routine)
+  return "@" + routine + "\n0;JMP"
+
+shared_call = """($$call)
+@SP
+A=M
+M=D
+@SP
+M=M+1
+""" + push_frame + """
+// ARG = SP-R14-5
+@R14
+D=M
+@5
+D=D+A
+@SP
+D=M-D
+@ARG
+M=D
+// LCL = SP
+@SP
+D=M
+@LCL
+M=D
+// goto R15
+@R15
+A=M
+0;JMP"""
+
+def shared_comparison(f):
+  return "($$" + f + """)
+@R13
+M=D
+@SP
+AM=M-1
+D=M
+@SP
+AM=M-1
+D=M-D
+@$$""" + f + """.true
+D;""" + jumps[f] + """
+@SP
+A=M
+M=0
+@$$""" + f + """.done
+0;JMP
+($$""" + f + """.true)
+@SP
+A=M
+M=-1
+($$""" + f + """.done)
+@SP
+M=M+1
+@R13
+A=M
+0;JMP"""
+
+shared_routines = { "$$call"     : shared_call,
+                    "$$return"   : "($$return)\n" + return_code,
+                    "$$return.d" : "($$return.d)\n" + return_from_D,
+                    "$$eq"       : shared_comparison("eq"),
+                    "$$gt"       : shared_comparison("gt"),
+                    "$$lt"       : shared_comparison("lt") }
+
+# Stops a program that runs off its end before it reaches the routines.
+def shared_code(shared):
+  return "($$end)\n@$$end\n0;JMP\n" + \
+         "".join([ "// " + routine + "\n" + shared_routines[routine] + "\n"
+                   for routine in sorted(shared) ])
+
+def translate_command(instruction, filename, shared = None):
+  out = []
   if len(instruction) == 3:
     if instruction[0] == "push":
       out.append(push_command(instruction[1], instruction[2], filename))
@@ -240,11 +406,13 @@ def translate_instruction(instruction, filename):
     elif instruction[0] == "function":
       out.append(function(name = instruction[1], \
                           num_locals = int(instruction[2])))
+    elif instruction[0] == "call" and shared is not None:
+      out.append(call_stub(instruction[1], instruction[2], shared))
     elif instruction[0] == "call":
       out.append(call(fun_name = instruction[1], \
                       num_args = instruction[2]))
     else:
-      raise(instruction[0])
+      raise Exception("Unknown command: " + instruction[0])
   elif len(instruction) == 2:
     label = filename + instruction[1]
     if instruction[0] == "label":
@@ -253,24 +421,369 @@ def translate_instruction(instruction, filename):
       out.append("@" + label + "\n0;JMP")
     elif instruction[0] == "if-goto":
       out.append(if_goto(label))
+    elif instruction[0] in branches:
+      out.append(branch(instruction[0], label))
+    else:
+      raise Exception("Unknown command: " + instruction[0])
   elif len(instruction) == 1:
     f = instruction[0]
-    if f == "return":
+    if f == "return" and shared is not None:
+      out.append(return_stub("$$return", shared))
+    elif f == "return":
       out.append(return_code)
     elif f in unary_functions:
       out.append(apply(f))
+    elif f in jumps and shared is not None:
+      out.append(compare_stub(f, shared))
     else:
       out.append(apply2(instruction[0]))
+  return out
+
+def translate_instruction(instruction, filename, shared = None):
+  out = [ "// " + instruction ] + \
+        translate_command(instruction.split(), filename, shared)
   return("\n".join(out) + "\n")
 
+# The optimizing translation parses the commands into a small typed IR,
+# rewrites it with the passes below and lowers it through StackCache.
+Push     = namedtuple("Push", "segment index")
+Pop      = namedtuple("Pop", "segment index")
+Move     = namedtuple("Move", "segment index target target_index")
+Drop     = namedtuple("Drop", "")
+Arith    = namedtuple("Arith", "op")
+Label    = namedtuple("Label", "label")
+Goto     = namedtuple("Goto", "label")
+IfGoto   = namedtuple("IfGoto", "label")
+Branch   = namedtuple("Branch", "condition label")
+Function = namedtuple("Function", "name num_locals")
+Call     = namedtuple("Call", "name num_args")
+Return   = namedtuple("Return", "")
+
+ir_commands = { "push"     : Push,
+                "pop"      : Pop,
+                "label"    : Label,
+                "goto"     : Goto,
+                "if-goto"  : IfGoto,
+                "function" : Function,
+                "call"     : Call,
+                "return"   : Return }
+
+def to_ir(instruction):
+  words = instruction.split()
+  if words[0] in ir_commands:
+    node = ir_commands[words[0]]
+    if len(words) != len(node._fields) + 1:
+      raise Exception("Bad command: " + instruction)
+    return node(*words[1:])
+  if len(words) == 1 and (words[0] in simple_functions or \
+                          words[0] in unary_functions or words[0] in jumps):
+    return Arith(words[0])
+  raise Exception("Unknown command: " + instruction)
+
+# The command a node stands for, as VM text.
+def ir_text(node):
+  if isinstance(node, Arith):
+    return node.op
+  if isinstance(node, Branch):
+    return "if-" + node.condition + " " + node.label
+  if isinstance(node, Move):
+    return "push " + node.segment + " " + node.index + ", pop " + \
+           node.target + " " + node.target_index
+  if isinstance(node, Drop):
+    return "pop (discard)"
+  return " ".join([ type(node).__name__.lower().replace("ifgoto", "if-goto")
+                  ] + list(node))
+
+def is_constant(node):
+  return isinstance(node, Push) and node.segment == "constant"
+
+# The translated comparisons test the sign of x - y, which wraps around
+# (32767 < -1 is true), and folding has to agree with them.
+def signed(x):
+  x &= 0xFFFF
+  return x - 0x10000 if x & 0x8000 else x
+
+folded = { "add" : lambda x, y: x + y,
+           "sub" : lambda x, y: x - y,
+           "and" : lambda x, y: x & y,
+           "or"  : lambda x, y: x | y,
+           "eq"  : lambda x, y: -(x == y),
+           "gt"  : lambda x, y: -(signed(x - y) > 0),
+           "lt"  : lambda x, y: -(signed(x - y) < 0),
+           "neg" : lambda x: -x,
+           "not" : lambda x: ~x }
+
+# Folded constants can fall outside 0..32767; see load_constant.
+def constant(value):
+  return Push("constant", str(value & 0xFFFF))
+
+def fold_constants(ir):
+  out = []
+  for node in ir:
+    if isinstance(node, Arith) and node.op in unary_functions and \
+       out and is_constant(out[-1]):
+      out[-1] = constant(folded[node.op](int(out[-1].index)))
+    elif isinstance(node, Arith) and len(out) > 1 and \
+         is_constant(out[-1]) and is_constant(out[-2]):
+      y = int(out.pop().index)
+      out[-1] = constant(folded[node.op](int(out[-1].index), y))
+    elif isinstance(node, IfGoto) and out and is_constant(out[-1]):
+      if int(out.pop().index) != 0:
+        out.append(Goto(node.label))
+    else:
+      out.append(node)
+  return out
+
+# The Jack compiler tests loop and if conditions with "lt, not, if-goto".
+# Jumping on the sign of x - y directly avoids materializing the boolean.
+def fuse_branches(ir):
+  out = []
+  for node in ir:
+    window = out[-2:]
+    if isinstance(node, IfGoto) and window and \
+       isinstance(window[-1], Arith) and window[-1].op in jumps:
+      out[-1] = Branch(window[-1].op, node.label)
+    elif isinstance(node, IfGoto) and len(window) == 2 and \
+         window[1] == Arith("not") and \
+         window[0] in [ Arith(f) for f in jumps ]:
+      out[-2:] = [ Branch(negated[window[0].op], node.label) ]
+    else:
+      out.append(node)
+  return out
+
+# "push x, pop y" becomes one move that leaves the stack alone.
+def fuse_moves(ir):
+  out = []
+  for node in ir:
+    if isinstance(node, Pop) and out and isinstance(out[-1], Push):
+      out[-1] = Move(out[-1].segment, out[-1].index,
+                     node.segment, node.index)
+    else:
+      out.append(node)
+  return out
+
+# Only for Jack compiler output, which uses temp as scratch space that is
+# never read after a call or return: a value stored there that is not read
+# again before one is dead. A dead move is dropped and a dead pop only
+# discards the top of the stack ("call f, pop temp 0" for do statements).
+# Liveness is computed backwards; a jump may go anywhere, so every temp is
+# live where one leaves.
+all_temps = frozenset([ str(i) for i in range(8) ])
+
+def discard_temps(ir):
+  out = []
+  dead = set()
+  for node in reversed(ir):
+    if isinstance(node, (Call, Return, Function)):
+      dead = set(all_temps)
+    elif isinstance(node, (Goto, IfGoto, Branch)):
+      dead = set()
+    elif isinstance(node, Move) and node.target == "temp":
+      if node.target_index in dead:
+        continue
+      dead.add(node.target_index)
+    elif isinstance(node, Pop) and node.segment == "temp":
+      if node.index in dead:
+        out.append(Drop())
+        continue
+      dead.add(node.index)
+    if isinstance(node, (Push, Move)) and node.segment == "temp":
+      dead.discard(node.index)
+    out.append(node)
+  return out[::-1]
+
+# Optimization levels: 1 keeps the exact VM semantics, 2 also assumes the
+# Jack compiler's conventions.
+def optimize_ir(ir, level = 1):
+  ir = fuse_moves(fuse_branches(fold_constants(ir)))
+  if level > 1:
+    ir = discard_temps(ir)
+  return ir
+
+# Optimizing translation: across a straight-line run of commands the top of
+# the stack is kept in D instead of memory. It is spilled to the stack only
+# where control flow can join or leave (labels, gotos, calls), so e.g.
+# "push x, push y, add" updates SP once instead of three times.
+cached_binary = { "add" : "D=D+M",
+                  "sub" : "D=M-D",
+                  "and" : "D=D&M",
+                  "or"  : "D=D|M" }
+
+# Any 16-bit constant, as folding can produce values an A-instruction
+# cannot hold.
+def load_constant(value):
+  value &= 0xFFFF
+  if value in (0, 1):
+    return "D=" + str(value)
+  if value == 0xFFFF:
+    return "D=-1"
+  if value < 0x8000:
+    return "@" + str(value) + "\nD=A"
+  if value != 0x8000:
+    return "@" + str(-value & 0xFFFF) + "\nD=-A"
+  return "@32767\nD=!A"
+
+# Small offsets into LCL/ARG/THIS/THAT are cheaper as a chain of A=A+1
+# than through the tmp registers, and they leave D alone.
+max_chained_offset = 6
+
+class StackCache:
+  def __init__(self, filename, shared = None):
+    self.filename = filename
+    self.shared = shared
+    self.cached = False         # is the top of the stack in D?
+
+  def spill(self):
+    if not self.cached:
+      return []
+    self.cached = False
+    return [ push_D[1:] ]
+
+  def fill(self):
+    if self.cached:
+      return []
+    self.cached = True
+    return [ pop_to_D[:-1] ]
+
+  def load(self, segment, index):
+    if segment == "constant":
+      return load_constant(int(index))
+    if segment in segments and segment not in direct and \
+       int(index) <= max_chained_offset:
+      return "@" + segments[segment] + "\n" + \
+             "\n".join(["A=M"] + ["A=A+1"] * int(index)) + "\nD=M"
+    return load_to_D(segment, index, self.filename)
+
+  def store(self, segment, index):
+    if segment in segments and segment not in direct and \
+       int(index) <= max_chained_offset:
+      return "@" + segments[segment] + "\n" + \
+             "\n".join(["A=M"] + ["A=A+1"] * int(index)) + "\nM=D"
+    return store_from_D(segment, index, self.filename)
+
+  def translate(self, node):
+    out = [ "// " + ir_text(node) ]
+    if isinstance(node, Push):
+      out += self.spill()
+      out.append(self.load(node.segment, node.index))
+      self.cached = True
+    elif isinstance(node, Pop):
+      out += self.fill()
+      out.append(self.store(node.segment, node.index))
+      self.cached = False
+    elif isinstance(node, Move):
+      out += self.spill()
+      out.append(self.load(node.segment, node.index))
+      out.append(self.store(node.target, node.target_index))
+    elif isinstance(node, Drop):
+      if not self.cached:
+        out.append("@SP\nM=M-1")
+      self.cached = False
+    elif isinstance(node, Arith) and node.op in cached_binary:
+      out += self.fill()
+      out.append("@SP\nAM=M-1\n" + cached_binary[node.op])
+    elif isinstance(node, Arith) and node.op in jumps and \
+         self.shared is not None:
+      out += self.spill()
+      out.append(compare_stub(node.op, self.shared))
+    elif isinstance(node, Arith) and node.op in jumps:
+      out += self.fill()
+      out.append("@SP\nAM=M-1\n" + compare_to_D(node.op))
+    elif isinstance(node, Arith):
+      out += self.fill()
+      out.append("D=" + unary_functions[node.op] + "D")
+    elif isinstance(node, IfGoto):
+      out += self.fill()
+      out.append("@" + self.filename + node.label + "\nD;JNE")
+      self.cached = False
+    elif isinstance(node, Branch):
+      out += self.fill()
+      out.append("@SP\nAM=M-1\n" + \
+                 compare_and_jump("if-" + node.condition,
+                                  self.filename + node.label))
+      self.cached = False
+    elif isinstance(node, Return):
+      out += self.fill()
+      if self.shared is None:
+        out.append(return_from_D)
+      else:
+        out.append(return_stub("$$return.d", self.shared))
+      self.cached = False
+    else:
+      out += self.spill()
+      out += translate_command(ir_text(node).split(), self.filename,
+                               self.shared)
+    return "\n".join(out) + "\n"
+
+  def finish(self):
+    return "".join([ line + "\n" for line in self.spill() ])
+
+def translate_program(instructions, filename, optimize = False,
+                      shared = None):
+  start_file(filename + "$")
+  if not optimize:
+    for instruction in instructions:
+      yield translate_instruction(instruction, filename, shared)
+    return
+  cache = StackCache(filename, shared)
+  for node in optimize_ir([ to_ir(i) for i in instructions ], optimize):
+    yield cache.translate(node)
+  yield cache.finish()
+
+def translate_file(input_file, optimize = False, shared = None):
+  filename = os.path.basename(input_file)[:-2]
+  return translate_program(parse(input_file), filename, optimize, shared)
+
+# A program is a (filename, instructions) pair; filename is the prefix of
+# its static and label symbols.
+def load_programs(vm_files):
+  return [ (os.path.basename(f)[:-2], parse(f)) for f in vm_files ]
+
+# Splits instructions into (function name, instructions) pieces. Anything
+# before the first function belongs to the piece named None.
+def split_functions(instructions):
+  out = [ (None, []) ]
+  for instruction in instructions:
+    if instruction.startswith("function"):
+      out.append((instruction.split()[1], []))
+    out[-1][1].append(instruction)
+  return [ piece for piece in out if piece[1] ]
+
+def reachable_functions(programs, root = "Sys.init"):
+  calls = {}
+  for filename, instructions in programs:
+    for name, body in split_functions(instructions):
+      calls[name] = [ i.split()[1] for i in body if i.startswith("call") ]
+  reachable = set()
+  pending = [ root ] + calls.get(None, [])
+  while pending:
+    name = pending.pop()
+    if name not in reachable:
+      reachable.add(name)
+      pending.extend(calls.get(name, []))
+  return reachable
+
+# Link-time dead code elimination: keeps the functions reachable from
+# Sys.init (the bootstrap's callee). Returns the stripped programs and the
+# dropped (filename, function name, instructions) triples.
+def strip_dead_functions(programs, root = "Sys.init"):
+  reachable = reachable_functions(programs, root)
+  kept = []
+  dropped = []
+  for filename, instructions in programs:
+    out = []
+    for name, body in split_functions(instructions):
+      if name is None or name in reachable:
+        out += body
+      else:
+        dropped.append((filename, name, body))
+    kept.append((filename, out))
+  return (kept, dropped)
+
 def is_vm_file(f):
   return f.endswith(".vm")
 
-def get_filenames():
-  parser = argparse.ArgumentParser()
-  parser.add_argument("input")
-  args = parser.parse_args()
-  input_file = args.input
+def get_filenames(input_file):
   print("Input (file or dir): ", input_file)
   if os.path.isfile(input_file):
     if is_vm_file(input_file):
@@ -289,24 +802,178 @@ def get_filenames():
         out.append(os.path.join(input_file, f))
     return (out, output_file, write_bootstrap)
     
-def main():
-  vm_files, output_file, write_bootstrap = get_filenames()
-  print("VM files: ", vm_files, "\nOutput file: ", output_file)
-  with open(output_file, 'w') as out:
-    if write_bootstrap:
-      out.write("""// initialize memory
+bootstrap = """// initialize memory
 @256
 D=A
 @SP
 M=D
-""" + call(fun_name = "Sys.init", num_args = "0"))
-    for input_file in vm_files:
-      filename = os.path.basename(input_file)[:-2]
-      print("Working on ", input_file)
-      instructions = parse(input_file)
-      for instruction in instructions:
-        out.write(translate_instruction(instruction, filename))
-      print("Done with ", input_file)
+"""
+
+def bootstrap_code():
+  start_file("")
+  return bootstrap + call(fun_name = "Sys.init", num_args = "0")
+
+# On-disk cache of translated files. A fragment is keyed by a hash of the
+# translator source, the options, the file's name (the prefix of its
+# symbols) and its commands, so editing one .vm file retranslates only that
+# file. The shared routines a fragment uses are read back from its jumps.
+shared_references = re.compile(r"^@(\$\$[\w.]+)$", re.M)
+
+class FragmentCache:
+  def __init__(self, directory):
+    self.directory = directory
+    self.hits = 0
+    self.misses = 0
+    with open(__file__, 'rb') as f:
+      self.version = hashlib.sha1(f.read()).hexdigest()
+    os.makedirs(directory, exist_ok = True)
+
+  def key(self, instructions, filename, optimize, shared):
+    text = "\n".join([ self.version, filename, str(optimize),
+                       str(shared is not None) ] + instructions)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+  def fragment(self, instructions, filename, optimize = False, shared = None):
+    path = os.path.join(self.directory,
+                        self.key(instructions, filename, optimize, shared) +
+                        ".asm")
+    if os.path.isfile(path):
+      self.hits += 1
+      with open(path, 'r') as f:
+        asm = f.read()
+    else:
+      self.misses += 1
+      asm = "".join(translate_program(instructions, filename, optimize,
+                                      shared))
+      with open(path + ".tmp", 'w') as out:
+        out.write(asm)
+      os.replace(path + ".tmp", path)
+    if shared is not None:
+      shared.update([ routine for routine in shared_references.findall(asm)
+                      if routine in shared_routines ])
+    return asm
+
+# Translates one file in a worker process. Labels are numbered per file,
+# so the result does not depend on which worker runs it.
+def translate_job(job):
+  instructions, filename, optimize, shared, cache = job
+  used = set() if shared else None
+  if cache is None:
+    asm = "".join(translate_program(instructions, filename, optimize, used))
+    return (asm, used, 0)
+  hits = cache.hits
+  asm = cache.fragment(instructions, filename, optimize, used)
+  return (asm, used, cache.hits - hits)
+
+def translate_parallel(programs, optimize, used, cache, jobs):
+  work = [ (instructions, filename, optimize, used is not None, cache)
+           for filename, instructions in programs ]
+  with ProcessPoolExecutor(max_workers = jobs) as pool:
+    for asm, shared, hits in pool.map(translate_job, work):
+      if used is not None:
+        used.update(shared)
+      if cache is not None:
+        cache.hits += hits
+        cache.misses += 1 - hits
+      yield asm
+
+# The link step: the bootstrap, each file's code (from the cache if there is
+# one) and the shared routines they use. Files keep their input order
+# whatever the number of jobs.
+def translate_programs(programs, write_bootstrap, optimize = False,
+                       shared = False, cache = None, jobs = 1):
+  used = set() if shared else None
+  if write_bootstrap:
+    yield bootstrap_code()
+  if jobs > 1:
+    yield from translate_parallel(programs, optimize, used, cache, jobs)
+  else:
+    for filename, instructions in programs:
+      if cache is None:
+        yield from translate_program(instructions, filename, optimize, used)
+      else:
+        yield cache.fragment(instructions, filename, optimize, used)
+  if used:
+    yield shared_code(used)
+
+# Dead functions can only be found from the bootstrap's Sys.init root.
+def translate_files(vm_files, write_bootstrap, optimize = False,
+                    shared = False, eliminate = False, cache = None,
+                    jobs = 1):
+  programs = load_programs(vm_files)
+  if eliminate and write_bootstrap:
+    programs, _ = strip_dead_functions(programs)
+  return translate_programs(programs, write_bootstrap, optimize, shared,
+                            cache, jobs)
+
+# Number of ROM words (instructions) in a piece of assembly.
+def rom_size(asm):
+  size = 0
+  for line in asm.split("\n"):
+    line = strip_comment(line)
+    if line != "" and line[0] != "(":
+      size += 1
+  return size
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input")
+  parser.add_argument("-O", "--optimize", action = "count", default = 0,
+                      help = "keep the top of the stack in D, fold constants "
+                             "and fuse comparisons with the branches that "
+                             "test them; -OO also drops dead stores to temp, "
+                             "which assumes Jack compiler output")
+  parser.add_argument("-S", "--shared", action = "store_true",
+                      help = "share one copy of the call, return and "
+                             "comparison code to shrink the ROM")
+  parser.add_argument("-E", "--eliminate-dead", action = "store_true",
+                      help = "drop functions that Sys.init never reaches "
+                             "(directory mode)")
+  parser.add_argument("--cache", nargs = "?", const = "", metavar = "DIR",
+                      help = "reuse translated files from DIR "
+                             "(default: .vmcache next to the output)")
+  parser.add_argument("--jobs", type = int, default = 1, metavar = "N",
+                      help = "translate the files in N processes")
+  parser.add_argument("-P", "--peephole", action = "store_true",
+                      help = "run peephole.py over the output")
+  args = parser.parse_args()
+  vm_files, output_file, write_bootstrap = get_filenames(args.input)
+  print("VM files: ", vm_files, "\nOutput file: ", output_file)
+  cache = None
+  if args.cache is not None:
+    cache = FragmentCache(args.cache or
+                          os.path.join(os.path.dirname(output_file),
+                                       ".vmcache"))
+  programs = load_programs(vm_files)
+  if args.eliminate_dead and write_bootstrap:
+    programs, dropped = strip_dead_functions(programs)
+    saved = 0
+    for filename, name, body in dropped:
+      words = rom_size("".join(translate_program(
+        body, filename, args.optimize, set() if args.shared else None)))
+      saved += words
+      print("Dropped ", name, "(" + str(words), "words)")
+    print("Dead functions: ", len(dropped), "dropped,", saved, "words saved")
+  size = 0
+  output = translate_programs(programs, write_bootstrap, args.optimize,
+                              args.shared, cache, args.jobs)
+  if args.peephole:
+    asm, hits = peephole.optimize_text("".join(output))
+    print("Peephole: ", rom_size(asm), "words, rules fired:")
+    peephole.print_hits(hits)
+    output = [ asm ]
+  with open(output_file, 'w') as out:
+    for asm in output:
+      out.write(asm)
+      size += rom_size(asm)
+  if cache is not None:
+    print("Cache: ", cache.hits, "hits,", cache.misses, "misses")
+  if args.shared:
+    inline = sum([ rom_size(asm) for asm in
+                   translate_programs(programs, write_bootstrap,
+                                      args.optimize) ])
+    print("ROM size: ", size, "words (" + str(inline), \
+          "without shared routines)")
         
 if __name__ == "__main__":
   main()
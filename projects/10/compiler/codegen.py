@@ -0,0 +1,390 @@
+from .tokenizer import Tokenizer, Token
+from .folding import Folder
+from .parser import Parser, EXPRESSION, OPERATORS, TERM, ARGUMENTS, \
+                    MORE_ARGUMENTS, CLOSE
+
+# Symbol kinds and the VM segments they live in.
+segments = { "static" : "static",
+             "field"  : "this",
+             "arg"    : "argument",
+             "var"    : "local" }
+
+binary_ops = { "+" : "add",
+               "-" : "sub",
+               "*" : "call Math.multiply 2",
+               "/" : "call Math.divide 2",
+               "&" : "and",
+               "|" : "or",
+               "<" : "lt",
+               ">" : "gt",
+               "=" : "eq" }
+
+unary_ops = { "-" : "neg",
+              "~" : "not" }
+
+# Further steps of the expression engine (see Parser.parse_steps).
+EMIT, CALL = CLOSE + 1, CLOSE + 2
+
+# Class scope (statics and fields) and subroutine scope (arguments and
+# locals). Symbols are (type, kind, index).
+class SymbolTable:
+  def __init__(self):
+    self.class_scope = {}
+    self.subroutine_scope = {}
+    self.counts = dict([ (kind, 0) for kind in segments ])
+
+  def start_subroutine(self):
+    self.subroutine_scope = {}
+    self.counts["arg"] = 0
+    self.counts["var"] = 0
+
+  def define(self, name, type, kind):
+    scope = self.class_scope if kind in ("static", "field") \
+            else self.subroutine_scope
+    if name in scope:
+      raise Exception("Duplicate definition of " + name)
+    scope[name] = (type, kind, self.counts[kind])
+    self.counts[kind] += 1
+
+  def var_count(self, kind):
+    return self.counts[kind]
+
+  def lookup(self, name):
+    if name in self.subroutine_scope:
+      return self.subroutine_scope[name]
+    return self.class_scope.get(name)
+
+# Compiles one class to VM code while parsing it: the parse_* rules of
+# Parser are replaced by ones that write VM commands instead of building a
+# tree. Commands go to write() as they are produced, one line each; with
+# optimize, a statement's commands go through a Folder first.
+class CodeGenerator(Parser):
+  def __init__(self, tokenizer, write, trace = None, stats = None,
+               optimize = False):
+    Parser.__init__(self, tokenizer, trace, stats)
+    self.write = write
+    self.folder = Folder(write) if optimize else None
+    self.symbols = SymbolTable()
+    self.labels = 0             # per class; vm_to_hack scopes them per file
+
+  def emit(self, command):
+    if self.folder is None:
+      self.write(command + "\n")
+    else:
+      self.folder.emit(command)
+
+  def new_label(self, kind):
+    self.labels += 1
+    return kind + str(self.labels)
+
+  def add_current_and_advance(self, tree = None):
+    self.advance()
+
+  def parse_name(self):
+    self.ensure_type(Token.IDENTIFIER)
+    name = self.token
+    self.advance()
+    return name
+
+  def parse_type(self, tree = None):
+    self.ensure_current_token_is_type()
+    type = self.token
+    self.advance()
+    return type
+
+  def push_variable(self, name):
+    type, kind, index = self.variable(name)
+    self.emit("push " + segments[kind] + " " + str(index))
+
+  def variable(self, name):
+    symbol = self.symbols.lookup(name)
+    if symbol is None:
+      raise Exception("Undefined variable " + name + " in " + \
+                      self.class_name + "." + self.subroutine_name)
+    return symbol
+
+  # static|field|var type name (, name)* ;
+  def parse_declaration(self, kind):
+    self.advance()
+    type = self.parse_type()
+    self.symbols.define(self.parse_name(), type, kind)
+    while self.token == ",":
+      self.advance()
+      self.symbols.define(self.parse_name(), type, kind)
+    self.parse_token(";", None)
+
+  def parse_classVarDec(self, tree = None):
+    self.parse_declaration(self.token)
+
+  def parse_varDecs(self, tree = None):
+    while self.token == "var":
+      self.parse_declaration("var")
+
+  def parse_parameter_list(self, tree = None):
+    if self.current_token_is_type():
+      type = self.parse_type()
+      self.symbols.define(self.parse_name(), type, "arg")
+      while self.token == ",":
+        self.advance()
+        type = self.parse_type()
+        self.symbols.define(self.parse_name(), type, "arg")
+
+  # Name and argument count (including the object) of a call whose first
+  # name has been read; the object, if any, is pushed.
+  def parse_call_head(self, tree, prev_token_type, prev_token):
+    if self.token == "(":
+      self.advance()
+      self.emit("push pointer 0")
+      return [ self.class_name + "." + prev_token, 1 ]
+    elif self.token == ".":
+      self.advance()
+      name = self.parse_name()
+      self.parse_token("(", None)
+      symbol = self.symbols.lookup(prev_token)
+      if symbol is None:          # function or constructor
+        return [ prev_token + "." + name, 0 ]
+      self.push_variable(prev_token)
+      return [ symbol[0] + "." + name, 1 ]
+    else:
+      raise Exception("Parsing subroutineCall. Expected '(' or '.', got " + self.token)
+
+  def parse_subroutine_call(self, tree, prev_token_type, prev_token):
+    call = self.parse_call_head(tree, prev_token_type, prev_token)
+    self.parse_steps([ (CALL, None, call),
+                       (CLOSE, None, ")"),
+                       (ARGUMENTS, None, call) ])
+
+  def parse_string(self, string):
+    self.emit("push constant " + str(len(string)))
+    self.emit("call String.new 1")
+    for c in string:
+      self.emit("push constant " + str(ord(c)))
+      self.emit("call String.appendChar 2")
+
+  def parse_term(self, tree, raise_if_not_a_term, steps):
+    if self.token_type == Token.INT_CONSTANT:
+      if int(self.token) > 32767:
+        raise Exception("Integer constant too large: " + self.token)
+      self.emit("push constant " + self.token)
+      self.advance()
+    elif self.token_type == Token.STR_CONSTANT:
+      self.parse_string(self.token)
+      self.advance()
+    elif self.token in ("false", "null"):
+      self.emit("push constant 0")
+      self.advance()
+    elif self.token == "true":
+      self.emit("push constant 0")
+      self.emit("not")
+      self.advance()
+    elif self.token == "this":
+      self.emit("push pointer 0")
+      self.advance()
+    elif self.token in unary_ops:
+      steps.append((EMIT, None, unary_ops[self.token]))
+      steps.append((TERM, None, True))
+      self.advance()
+    elif self.token == "(":
+      self.advance()
+      steps.append((CLOSE, None, ")"))
+      steps.append((EXPRESSION, None, True))
+    elif self.token_type == Token.IDENTIFIER:
+      name = self.token
+      self.advance()
+      if self.token == "[":          # varName [ expression ]
+        self.push_variable(name)
+        self.advance()
+        steps.append((EMIT, None, "push that 0"))
+        steps.append((EMIT, None, "pop pointer 1"))
+        steps.append((EMIT, None, "add"))
+        steps.append((CLOSE, None, "]"))
+        steps.append((EXPRESSION, None, True))
+      elif self.token in "(.":        # subroutineCall
+        call = self.parse_call_head(None, Token.IDENTIFIER, name)
+        steps.append((CALL, None, call))
+        steps.append((CLOSE, None, ")"))
+        steps.append((ARGUMENTS, None, call))
+      else:                       # varName
+        self.push_variable(name)
+    elif raise_if_not_a_term:
+      raise Exception("Expected term. Got: " + self.token_type.name + " " + self.token)
+
+  # Like Parser.parse_steps, with operators applied after their right
+  # operand and the arguments of a call counted.
+  def parse_steps(self, steps):
+    while steps:
+      step, _, arg = steps.pop()
+      if step == EXPRESSION:
+        steps.append((OPERATORS, None, None))
+        steps.append((TERM, None, arg))
+      elif step == OPERATORS:
+        if self.token in binary_ops:
+          steps.append((OPERATORS, None, None))
+          steps.append((EMIT, None, binary_ops[self.token]))
+          steps.append((TERM, None, True))
+          self.advance()
+      elif step == TERM:
+        self.parse_term(None, arg, steps)
+      elif step == EMIT:
+        self.emit(arg)
+      elif step == ARGUMENTS:
+        if self.token != ")":
+          arg[1] += 1
+          steps.append((MORE_ARGUMENTS, None, arg))
+          steps.append((EXPRESSION, None, True))
+      elif step == MORE_ARGUMENTS:
+        if self.token == ",":
+          self.advance()
+          arg[1] += 1
+          steps.append((MORE_ARGUMENTS, None, arg))
+          steps.append((EXPRESSION, None, True))
+      elif step == CALL:
+        self.emit("call " + arg[0] + " " + str(arg[1]))
+      else:                       # CLOSE
+        self.parse_token(arg, None)
+
+  def parse_let_statement(self, tree = None):
+    self.advance()
+    name = self.parse_name()
+    if self.token == "[":
+      self.push_variable(name)
+      self.advance()
+      self.parse_expression(None, raise_if_not_a_term = True)
+      self.parse_token("]", None)
+      self.emit("add")
+      self.parse_token("=", None)
+      self.parse_expression(None, raise_if_not_a_term = True)
+      self.emit("pop temp 0")
+      self.emit("pop pointer 1")
+      self.emit("push temp 0")
+      self.emit("pop that 0")
+    else:
+      type, kind, index = self.variable(name)
+      self.parse_token("=", None)
+      self.parse_expression(None, raise_if_not_a_term = True)
+      self.emit("pop " + segments[kind] + " " + str(index))
+    self.parse_token(";", None)
+
+  def parse_if_statement(self, tree = None):
+    self.advance()
+    self.parse_token("(", None)
+    self.parse_expression(None, raise_if_not_a_term = True)
+    self.parse_token(")", None)
+    otherwise = self.new_label("IF_FALSE")
+    self.emit("not")
+    self.emit("if-goto " + otherwise)
+    self.parse_token("{", None)
+    self.parse_statements()
+    self.parse_token("}", None)
+    if self.token == "else":
+      end = self.new_label("IF_END")
+      self.emit("goto " + end)
+      self.emit("label " + otherwise)
+      self.advance()
+      self.parse_token("{", None)
+      self.parse_statements()
+      self.parse_token("}", None)
+      self.emit("label " + end)
+    else:
+      self.emit("label " + otherwise)
+
+  def parse_while_statement(self, tree = None):
+    self.advance()
+    top = self.new_label("WHILE_EXP")
+    end = self.new_label("WHILE_END")
+    self.emit("label " + top)
+    self.parse_token("(", None)
+    self.parse_expression(None, raise_if_not_a_term = True)
+    self.parse_token(")", None)
+    self.emit("not")
+    self.emit("if-goto " + end)
+    self.parse_token("{", None)
+    self.parse_statements()
+    self.parse_token("}", None)
+    self.emit("goto " + top)
+    self.emit("label " + end)
+
+  def parse_do_statement(self, tree = None):
+    self.advance()
+    name = self.parse_name()
+    self.parse_subroutine_call(None, Token.IDENTIFIER, name)
+    self.emit("pop temp 0")
+    self.parse_token(";", None)
+
+  def parse_return_statement(self, tree = None):
+    self.advance()
+    if self.token != ";":
+      self.parse_expression(None, raise_if_not_a_term = True)
+    else:
+      self.emit("push constant 0")
+    self.emit("return")
+    self.parse_token(";", None)
+
+  def parse_statements(self, tree = None):
+    statements = { "let"    : self.parse_let_statement,
+                   "if"     : self.parse_if_statement,
+                   "while"  : self.parse_while_statement,
+                   "do"     : self.parse_do_statement,
+                   "return" : self.parse_return_statement }
+    while self.token in statements:
+      statements[self.token]()
+
+  def parse_subroutineBody(self, tree, kind):
+    self.parse_token("{", None)
+    self.parse_varDecs()
+    self.emit("function " + self.class_name + "." + self.subroutine_name + \
+              " " + str(self.symbols.var_count("var")))
+    if kind == "constructor":
+      self.emit("push constant " + str(self.symbols.var_count("field")))
+      self.emit("call Memory.alloc 1")
+      self.emit("pop pointer 0")
+    elif kind == "method":
+      self.emit("push argument 0")
+      self.emit("pop pointer 0")
+    self.parse_statements()
+    self.parse_token("}", None)
+
+  def parse_subroutineDec(self, tree = None):
+    kind = self.token
+    self.advance()
+    self.parse_type()
+    self.subroutine_name = self.parse_name()
+    self.symbols.start_subroutine()
+    if kind == "method":
+      self.symbols.define("this", self.class_name, "arg")
+    self.parse_token("(", None)
+    self.parse_parameter_list()
+    self.parse_token(")", None)
+    self.parse_subroutineBody(None, kind)
+
+  def parse_class(self):
+    if not self.tokenizer.has_tokens():
+      return
+    self.advance()
+    self.ensure_token_is("class")
+    self.advance()
+    self.class_name = self.parse_name()
+    self.subroutine_name = None
+    self.parse_token("{", None)
+    while self.token in ["static", "field"]:
+      self.parse_classVarDec()
+    while self.token in ["constructor", "function", "method"]:
+      self.parse_subroutineDec()
+    self.ensure_token_is("}")
+    if self.tokenizer.has_tokens():
+      raise Exception("Unexpected tokens after the class")
+    if self.folder is not None:
+      self.folder.flush()
+    return self.class_name
+
+# input is a filename or a token list from read_tokens; the VM code goes
+# to write(). Returns the class name.
+def compile_class(input, write, trace = None, stats = None, optimize = False):
+  generator = CodeGenerator(Tokenizer(input), write, trace, stats, optimize)
+  return generator.parse_class()
+
+# The VM code of a class as a list of lines.
+def compile_to_lines(input, optimize = False):
+  lines = []
+  compile_class(input, lines.append, optimize = optimize)
+  return "".join(lines).splitlines()
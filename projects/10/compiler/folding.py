@@ -0,0 +1,213 @@
+# Optimizes the VM code of expressions as CodeGenerator emits it. Commands
+# are held back until the expression stack they build is empty again (the
+# end of a statement, or a branch); meanwhile each value on that stack is
+# an Operand that knows where its code starts and whether it is a known
+# constant. Operators applied to them are folded, simplified (x + 0,
+# x * 1, ~~x, ...) or, for multiplication by a small constant, reduced to
+# additions, so fewer calls to Math.multiply are made.
+
+def signed(x):
+  x &= 0xFFFF
+  return x - 0x10000 if x & 0x8000 else x
+
+# Jack's division truncates towards zero.
+def divide(x, y):
+  quotient = abs(x) // abs(y)
+  return -quotient if (x < 0) != (y < 0) else quotient
+
+MULTIPLY = "call Math.multiply 2"
+DIVIDE = "call Math.divide 2"
+
+# lt and gt test the sign of x - y, as the translated code does.
+folded = { "add"    : lambda x, y: x + y,
+           "sub"    : lambda x, y: x - y,
+           "and"    : lambda x, y: x & y,
+           "or"     : lambda x, y: x | y,
+           "eq"     : lambda x, y: -1 if x == y else 0,
+           "lt"     : lambda x, y: -1 if signed(x - y) < 0 else 0,
+           "gt"     : lambda x, y: -1 if signed(x - y) > 0 else 0,
+           MULTIPLY : lambda x, y: x * y,
+           DIVIDE   : divide }
+
+# x * c is reduced when its doublings plus twice its additions are at
+# most this; beyond it the code grows more than the call is worth.
+max_reduction_cost = 8
+
+doubling = [ "pop temp 0", "push temp 0", "push temp 0", "add" ]
+
+def constant_code(value):
+  if value == -32768:
+    return [ "push constant 32767", "not" ]
+  elif value < 0:
+    return [ "push constant " + str(-value), "neg" ]
+  return [ "push constant " + str(value) ]
+
+def reducible(c):
+  c = abs(c)
+  cost = c.bit_length() - 1 + 2 * (bin(c).count("1") - 1)
+  return c > 1 and cost <= max_reduction_cost
+
+class Operand:
+  __slots__ = ("start", "value", "pure", "last")
+
+  def __init__(self, start, value = None, pure = True):
+    self.start = start          # index of its first command in the buffer
+    self.value = value          # the constant, if known
+    self.pure = pure            # can the code go without changing anything?
+    self.last = None            # unary operator its code ends with
+
+class Folder:
+  def __init__(self, write):
+    self.write = write
+    self.code = []
+    self.stack = []
+    self.carry = None           # (start, pure) of code popped since a push
+
+  def flush(self):
+    if self.code:
+      self.write("".join([ command + "\n" for command in self.code ]))
+    self.code = []
+    self.stack = []
+    self.carry = None
+
+  def emit(self, command):
+    words = command.split()
+    if command in folded:
+      self.binary(command)
+    elif command in ("neg", "not"):
+      self.unary(command)
+    elif words[0] == "push":
+      value = int(words[2]) if words[1] == "constant" else None
+      self.operand(len(self.code), value, True)
+      self.code.append(command)
+    elif words[0] == "pop":
+      popped = self.stack.pop()
+      self.code.append(command)
+      if not self.stack:
+        self.flush()
+      elif self.carry is None:
+        self.carry = (popped.start, popped.pure)
+      else:
+        self.carry = (min(self.carry[0], popped.start),
+                      self.carry[1] and popped.pure)
+    elif words[0] == "call":
+      n = int(words[2])
+      start = self.stack[-n].start if n else len(self.code)
+      del self.stack[len(self.stack) - n:]
+      self.operand(start, None, False)
+      self.code.append(command)
+    else:                       # label, goto, function, return, ...
+      self.flush()
+      self.write(command + "\n")
+
+  # A new value; code popped just before it is part of its code.
+  def operand(self, start, value, pure):
+    if self.carry is not None:
+      start = min(start, self.carry[0])
+      pure = pure and self.carry[1]
+      value = None
+      self.carry = None
+    self.stack.append(Operand(start, value, pure))
+
+  def replace_with_constant(self, x, value):
+    value = signed(value)
+    self.code[x.start:] = constant_code(value)
+    x.value = value
+    x.pure = True
+    x.last = None
+
+  def single_push(self, x):
+    return len(self.code) - x.start == 1 and \
+           self.code[x.start].startswith("push ") and x.value is None
+
+  def unary(self, op):
+    x = self.stack[-1]
+    if x.value is not None:
+      self.replace_with_constant(x, -x.value if op == "neg" else ~x.value)
+    elif x.last == op:          # --x, ~~x
+      self.code.pop()
+      x.last = None
+    else:
+      self.code.append(op)
+      x.last = op
+
+  # Removes the code of the left operand; the right one takes its place.
+  def drop_left(self):
+    right = self.stack.pop()
+    left = self.stack.pop()
+    del self.code[left.start:right.start]
+    right.start = left.start
+    self.stack.append(right)
+
+  def drop_right(self):
+    right = self.stack.pop()
+    del self.code[right.start:]
+
+  def binary(self, op):
+    right = self.stack[-1]
+    left = self.stack[-2]
+    x, y = left.value, right.value
+    if x is not None and y is not None and \
+       not (op == DIVIDE and (y == 0 or -32768 in (x, y))):
+      self.stack.pop()
+      self.replace_with_constant(left, folded[op](x, y))
+    elif self.simplify(op, left, right, x, y):
+      pass
+    else:
+      self.code.append(op)
+      self.stack.pop()
+      left.value = None
+      left.pure = left.pure and right.pure and not op.startswith("call")
+      left.last = None
+
+  # Identities and strength reduction; returns whether one applied.
+  def simplify(self, op, left, right, x, y):
+    if y == 0 and op in ("add", "sub", "or") or \
+       y == -1 and op == "and" or \
+       y == 1 and op in (MULTIPLY, DIVIDE):
+      self.drop_right()
+    elif x == 0 and op in ("add", "or") or \
+         x == -1 and op == "and" or \
+         x == 1 and op == MULTIPLY:
+      self.drop_left()
+    elif y == -1 and op in (MULTIPLY, DIVIDE):
+      self.drop_right()
+      self.unary("neg")
+    elif x == 0 and op == "sub" or x == -1 and op == MULTIPLY:
+      self.drop_left()
+      self.unary("neg")
+    elif op in ("and", MULTIPLY) and 0 in (x, y) and left.pure and right.pure:
+      self.stack.pop()
+      self.replace_with_constant(left, 0)
+    elif op == "or" and -1 in (x, y) and left.pure and right.pure:
+      self.stack.pop()
+      self.replace_with_constant(left, -1)
+    elif op == MULTIPLY and y is not None and reducible(y):
+      self.drop_right()
+      self.multiply(y)
+    elif op == MULTIPLY and x is not None and reducible(x):
+      self.drop_left()
+      self.multiply(x)
+    else:
+      return False
+    return True
+
+  # The value on top times c, by doubling and adding: c's bits are taken
+  # from the top, with the value kept in temp 1 when it is needed again.
+  def multiply(self, c):
+    x = self.stack[-1]
+    bits = bin(abs(c))[3:]
+    if bits == "0" and self.single_push(x):
+      self.code += [ self.code[x.start], "add" ]
+    elif "1" not in bits:
+      self.code += doubling * len(bits)
+    else:
+      self.code += [ "pop temp 1", "push temp 1" ]
+      for bit in bits:
+        self.code += doubling
+        if bit == "1":
+          self.code += [ "push temp 1", "add" ]
+    x.value = None
+    x.last = None
+    if c < 0:
+      self.unary("neg")
@@ -0,0 +1,78 @@
+import time
+
+# Per-rule counters for Parser: calls, total time (including nested rules)
+# and own time (excluding them), in seconds.
+class RuleStats:
+  def __init__(self):
+    self.calls = {}
+    self.total = {}
+    self.own = {}
+    self.nested = []            # time spent in callees, per active rule
+
+  def enter(self):
+    self.nested.append(0.0)
+
+  def leave(self, rule, elapsed):
+    nested = self.nested.pop()
+    self.calls[rule] = self.calls.get(rule, 0) + 1
+    self.total[rule] = self.total.get(rule, 0.0) + elapsed
+    self.own[rule] = self.own.get(rule, 0.0) + elapsed - nested
+    if self.nested:
+      self.nested[-1] += elapsed
+
+  # Adds the counts of another RuleStats, e.g. one from a worker process.
+  def merge(self, other):
+    for rule in other.calls:
+      self.calls[rule] = self.calls.get(rule, 0) + other.calls[rule]
+      self.total[rule] = self.total.get(rule, 0.0) + other.total[rule]
+      self.own[rule] = self.own.get(rule, 0.0) + other.own[rule]
+
+  # (rule, calls, total, own) rows, most own time first.
+  def rows(self):
+    return sorted([ (rule, self.calls[rule], self.total[rule], self.own[rule])
+                    for rule in self.calls ], key = lambda row: -row[3])
+
+  def report(self):
+    lines = [ "{0:30} {1:>8} {2:>10} {3:>10}".format("rule", "calls",
+                                                     "total ms", "own ms") ]
+    for rule, calls, total, own in self.rows():
+      lines.append("{0:30} {1:>8} {2:>10.1f} {3:>10.1f}".format(
+        rule, calls, 1000 * total, 1000 * own))
+    return "\n".join(lines)
+
+# Prints trace events, indented by rule depth.
+class PrintTrace:
+  def __init__(self, out = None):
+    self.out = out
+    self.depth = 0
+
+  def __call__(self, event, *args):
+    if event == "leave":
+      self.depth -= 1
+      return
+    print("  " * self.depth + event, *args, file = self.out)
+    if event == "enter":
+      self.depth += 1
+
+def wrap(rule, method, trace, stats):
+  def instrumented(*args, **kwargs):
+    if trace is not None:
+      trace("enter", rule)
+    if stats is not None:
+      stats.enter()
+    start = time.perf_counter()
+    try:
+      return method(*args, **kwargs)
+    finally:
+      if stats is not None:
+        stats.leave(rule, time.perf_counter() - start)
+      if trace is not None:
+        trace("leave", rule)
+  return instrumented
+
+# Replaces the parse_* methods of one parser object with instrumented
+# ones; other parsers, and the class itself, keep the plain methods.
+def instrument(parser, trace = None, stats = None):
+  for name in dir(type(parser)):
+    if name.startswith("parse_"):
+      setattr(parser, name, wrap(name, getattr(parser, name), trace, stats))
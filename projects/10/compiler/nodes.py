@@ -0,0 +1,99 @@
+from .tokenizer import token_type_to_str
+import xml.etree.ElementTree as ET
+
+# Syntax tree of a Jack class. There is one node class per grammar rule;
+# a node's children are nodes and (token type, token) pairs, in source
+# order, so the tree keeps every token of the class.
+class Node:
+  __slots__ = ("children",)
+  tag = None
+
+  def __init__(self, children = None):
+    self.children = [] if children is None else children
+
+  def append(self, child):
+    self.children.append(child)
+
+  def nodes(self):
+    return [ c for c in self.children if isinstance(c, Node) ]
+
+  def tokens(self):
+    return [ c for c in self.children if not isinstance(c, Node) ]
+
+  # The tree as ElementTree elements, built on demand for XML output.
+  def to_element(self, parent = None):
+    if parent is None:
+      element = ET.Element(self.tag)
+    else:
+      element = ET.SubElement(parent, self.tag)
+    for child in self.children:
+      if isinstance(child, Node):
+        child.to_element(element)
+      else:
+        leaf = ET.SubElement(element, token_type_to_str(child[0]))
+        leaf.text = child[1]
+    return element
+
+class Tokens(Node):
+  __slots__ = ()
+  tag = "tokens"
+
+class Class(Node):
+  __slots__ = ()
+  tag = "class"
+
+class ClassVarDec(Node):
+  __slots__ = ()
+  tag = "classVarDec"
+
+class SubroutineDec(Node):
+  __slots__ = ()
+  tag = "subroutineDec"
+
+class ParameterList(Node):
+  __slots__ = ()
+  tag = "parameterList"
+
+class SubroutineBody(Node):
+  __slots__ = ()
+  tag = "subroutineBody"
+
+class VarDec(Node):
+  __slots__ = ()
+  tag = "varDec"
+
+class Statements(Node):
+  __slots__ = ()
+  tag = "statements"
+
+class LetStatement(Node):
+  __slots__ = ()
+  tag = "letStatement"
+
+class IfStatement(Node):
+  __slots__ = ()
+  tag = "ifStatement"
+
+class WhileStatement(Node):
+  __slots__ = ()
+  tag = "whileStatement"
+
+class DoStatement(Node):
+  __slots__ = ()
+  tag = "doStatement"
+
+class ReturnStatement(Node):
+  __slots__ = ()
+  tag = "returnStatement"
+
+class Expression(Node):
+  __slots__ = ()
+  tag = "expression"
+
+class Term(Node):
+  __slots__ = ()
+  tag = "term"
+
+class ExpressionList(Node):
+  __slots__ = ()
+  tag = "expressionList"
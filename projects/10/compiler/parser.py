@@ -1,18 +1,41 @@
-from .tokenizer import Tokenizer, Token, token_type_to_str
-import xml.etree.ElementTree as ET
+from .tokenizer import Tokenizer, Token, token_type_to_str, read_tokens
+from .instrument import instrument
+from .nodes import Tokens, Class, ClassVarDec, SubroutineDec, ParameterList, \
+                   SubroutineBody, VarDec, Statements, LetStatement, \
+                   IfStatement, WhileStatement, DoStatement, ReturnStatement, \
+                   Expression, Term, ExpressionList
+
+# Leaves are immutable (type, token) pairs, so equal ones are shared.
+leaves = {}
 
 def add(tree, token_type, token):
-  child = ET.SubElement(tree, token_type_to_str(token_type))
-  child.text = token
+  leaf = (token_type, token)
+  tree.append(leaves.setdefault(leaf, leaf))
+
+def subnode(tree, node_class):
+  child = node_class()
+  tree.append(child)
+  return child
+
+# Steps of the expression parser (see parse_steps).
+EXPRESSION, OPERATORS, TERM, ARGUMENTS, MORE_ARGUMENTS, CLOSE = range(6)
 
+# trace is called as trace("token", type, token, line, col) for every token
+# and trace("enter"/"leave", rule) around every parse_* rule; stats is a
+# RuleStats. Without them the parser runs uninstrumented.
 class Parser:
-  def __init__(self, tokenizer):
+  def __init__(self, tokenizer, trace = None, stats = None):
     self.tokenizer = tokenizer
+    self.trace = trace
+    if trace is not None or stats is not None:
+      instrument(self, trace, stats)
 
   def advance(self):
     if self.tokenizer.has_tokens():
       self.token_type, self.token = self.tokenizer.advance()
-      print ("Advancing: ", token_type_to_str(self.token_type), self.token)
+      if self.trace is not None:
+        self.trace("token", token_type_to_str(self.token_type), self.token,
+                   self.tokenizer.line, self.tokenizer.col)
     else:
       raise Exception("Ran out of tokens")
 
@@ -59,7 +82,7 @@ class Parser:
       self.parse_varName(tree)       # add varName
 
   def parse_classVarDec(self, tree):
-    tree = ET.SubElement(tree, "classVarDec")
+    tree = subnode(tree, ClassVarDec)
     self.add_current_and_advance(tree) # static | field
     self.parse_type(tree)
     self.parse_varNames(tree)
@@ -71,7 +94,7 @@ class Parser:
   
   # 0 or 1 times
   def parse_parameter_list(self, tree):
-    tree = ET.SubElement(tree, "parameterList")
+    tree = subnode(tree, ParameterList)
     if self.current_token_is_type():
       self.parse_parameter(tree)
       while self.token == ",":
@@ -80,43 +103,47 @@ class Parser:
 
   def parse_varDecs(self, tree):
     while self.token == "var":
-      varDec = ET.SubElement(tree, "varDec")
+      varDec = subnode(tree, VarDec)
       self.add_current_and_advance(varDec)
       self.parse_type(varDec)
       self.parse_varNames(varDec)
       self.parse_token(";", varDec)
 
-  def parse_subroutine_call(self, tree, prev_token_type, prev_token):
+  # name ( or name . name ( -- the call up to its argument list.
+  def parse_call_head(self, tree, prev_token_type, prev_token):
     add(tree, prev_token_type, prev_token)
     if self.token == "(":
       self.add_current_and_advance(tree)
-      self.parse_expression_list(tree)
-      self.parse_token(")", tree)
     elif self.token == ".":
       self.add_current_and_advance(tree)
       self.parse_varName(tree)
       self.parse_token("(", tree)
-      self.parse_expression_list(tree)
-      self.parse_token(")", tree)
     else:
       raise Exception("Parsing subroutineCall. Expected '(' or '.', got " + self.token)
 
-  def parse_term(self, tree, raise_if_not_a_term):
-    tree = ET.SubElement(tree, "term")
+  def parse_subroutine_call(self, tree, prev_token_type, prev_token):
+    self.parse_call_head(tree, prev_token_type, prev_token)
+    self.parse_expression_list(tree)
+    self.parse_token(")", tree)
+
+  # Parses the start of a term; whatever nests inside it (a term after a
+  # unary operator, an expression in brackets, call arguments) is pushed
+  # onto steps for parse_steps to do.
+  def parse_term(self, tree, raise_if_not_a_term, steps):
+    tree = subnode(tree, Term)
     keyword_constants = { "true", "false", "null", "this" }
     unary_ops = "-~"
-    print ("Parsing term. ", self.token)
     if self.token_type in [Token.INT_CONSTANT, Token.STR_CONSTANT]:
       self.add_current_and_advance(tree)
     elif self.token in keyword_constants:
       self.add_current_and_advance(tree)
     elif self.token in unary_ops:
       self.add_current_and_advance(tree)
-      self.parse_term(tree, raise_if_not_a_term = True)
+      steps.append((TERM, tree, True))
     elif self.token == "(":
       self.add_current_and_advance(tree)
-      self.parse_expression(tree, raise_if_not_a_term = True)
-      self.parse_token(")", tree)
+      steps.append((CLOSE, tree, ")"))
+      steps.append((EXPRESSION, tree, True))
     elif self.token_type == Token.IDENTIFIER:
       prev_token = self.token
       prev_token_type = self.token_type
@@ -124,34 +151,58 @@ class Parser:
       if self.token == "[":          # varName [ expression ]
         add(tree, prev_token_type, prev_token)
         self.add_current_and_advance(tree)
-        self.parse_expression(tree, raise_if_not_a_term = True)
-        self.parse_token("]", tree)
+        steps.append((CLOSE, tree, "]"))
+        steps.append((EXPRESSION, tree, True))
       elif self.token in "(.":        # subroutineCall
-        self.parse_subroutine_call(tree, prev_token_type, prev_token)
+        self.parse_call_head(tree, prev_token_type, prev_token)
+        steps.append((CLOSE, tree, ")"))
+        steps.append((ARGUMENTS, tree, None))
       else:                       # varName
         add(tree, prev_token_type, prev_token)
     else: # this was not a term
       if raise_if_not_a_term:
         raise Exception("Expected term. Got: " + self.token_type.name + " " + self.token)
-    
-  def parse_expression(self, tree, raise_if_not_a_term):
-    tree = ET.SubElement(tree, "expression")
-    self.parse_term(tree, raise_if_not_a_term)
+
+  # Expressions are parsed from an explicit stack of pending steps rather
+  # than by recursion, so they can nest as deep as memory allows. Jack's
+  # operators have no precedence and apply left to right, so an expression
+  # is a flat run of terms and operators; only terms nest.
+  def parse_steps(self, steps):
     ops = "+-*/&|<>="
-    while self.token in ops:
-      self.add_current_and_advance(tree)
-      self.parse_term(tree, raise_if_not_a_term = True)
+    while steps:
+      step, tree, arg = steps.pop()
+      if step == EXPRESSION:
+        tree = subnode(tree, Expression)
+        steps.append((OPERATORS, tree, None))
+        steps.append((TERM, tree, arg))
+      elif step == OPERATORS:
+        if self.token in ops:
+          self.add_current_and_advance(tree)
+          steps.append((OPERATORS, tree, None))
+          steps.append((TERM, tree, True))
+      elif step == TERM:
+        self.parse_term(tree, arg, steps)
+      elif step == ARGUMENTS:
+        tree = subnode(tree, ExpressionList)
+        if self.token != ")":
+          steps.append((MORE_ARGUMENTS, tree, None))
+          steps.append((EXPRESSION, tree, False))
+      elif step == MORE_ARGUMENTS:
+        if self.token == ",":
+          self.add_current_and_advance(tree)
+          steps.append((MORE_ARGUMENTS, tree, None))
+          steps.append((EXPRESSION, tree, True))
+      else:                       # CLOSE
+        self.parse_token(arg, tree)
+
+  def parse_expression(self, tree, raise_if_not_a_term):
+    self.parse_steps([ (EXPRESSION, tree, raise_if_not_a_term) ])
 
   def parse_expression_list(self, tree):
-    tree = ET.SubElement(tree, "expressionList")
-    if self.token != ")":
-      self.parse_expression(tree, raise_if_not_a_term = False)
-      while self.token == ",":
-        self.add_current_and_advance(tree)
-        self.parse_expression(tree, raise_if_not_a_term = True)
+    self.parse_steps([ (ARGUMENTS, tree, None) ])
     
   def parse_let_statement(self, tree):
-    tree = ET.SubElement(tree, "letStatement")
+    tree = subnode(tree, LetStatement)
     self.add_current_and_advance(tree)
     self.parse_varName(tree)
     if self.token == "[":
@@ -163,7 +214,7 @@ class Parser:
     self.parse_token(";", tree)
 
   def parse_if_statement(self, tree):
-    tree = ET.SubElement(tree, "ifStatement")
+    tree = subnode(tree, IfStatement)
     self.add_current_and_advance(tree)
     self.parse_token("(", tree)
     self.parse_expression(tree, raise_if_not_a_term = True)
@@ -178,7 +229,7 @@ class Parser:
       self.parse_token("}", tree)
       
   def parse_while_statement(self, tree):
-    tree = ET.SubElement(tree, "whileStatement")
+    tree = subnode(tree, WhileStatement)
     self.add_current_and_advance(tree)
     self.parse_token("(", tree)
     self.parse_expression(tree, raise_if_not_a_term = True)
@@ -188,7 +239,7 @@ class Parser:
     self.parse_token("}", tree)
 
   def parse_do_statement(self, tree):
-    tree = ET.SubElement(tree, "doStatement")
+    tree = subnode(tree, DoStatement)
     self.add_current_and_advance(tree)
     prev_token_type = self.token_type
     prev_token = self.token
@@ -197,14 +248,14 @@ class Parser:
     self.parse_token(";", tree)
 
   def parse_return_statement(self, tree):
-    tree = ET.SubElement(tree, "returnStatement")
+    tree = subnode(tree, ReturnStatement)
     self.add_current_and_advance(tree)
     if self.token != ";":
       self.parse_expression(tree, raise_if_not_a_term = True)
     self.parse_token(";", tree)
   
   def parse_statements(self, tree):
-    tree = ET.SubElement(tree, "statements")
+    tree = subnode(tree, Statements)
     statements = { "let"    : self.parse_let_statement,
                    "if"     : self.parse_if_statement,
                    "while"  : self.parse_while_statement,
@@ -214,14 +265,14 @@ class Parser:
       statements[self.token](tree)
       
   def parse_subroutineBody(self, tree):
-    tree = ET.SubElement(tree, "subroutineBody")
+    tree = subnode(tree, SubroutineBody)
     self.parse_token("{", tree)
     self.parse_varDecs(tree)
     self.parse_statements(tree)
     self.parse_token("}", tree)
     
   def parse_subroutineDec(self, tree):
-    tree = ET.SubElement(tree, "subroutineDec")
+    tree = subnode(tree, SubroutineDec)
     self.add_current_and_advance(tree)
     self.parse_type(tree)
     self.add_current_and_advance(tree)  # subroutineName
@@ -236,7 +287,7 @@ class Parser:
     self.advance()              # get first token
     if self.token != "class":
       raise ("Excpected 'class', got " + self.token)
-    tree = ET.Element("class")
+    tree = Class()
     self.add_current_and_advance(tree)
     self.ensure_type(Token.IDENTIFIER) # className
     self.add_current_and_advance(tree)
@@ -251,16 +302,16 @@ class Parser:
     add(tree, self.token_type, self.token)
     return tree
   
-def parse(input_file):
-  tokenizer = Tokenizer(input_file)
-  parser = Parser(tokenizer)
+# input is a filename or a token list from read_tokens.
+def parse(input, trace = None, stats = None):
+  tokenizer = Tokenizer(input)
+  parser = Parser(tokenizer, trace, stats)
   return parser.parse_class()
 
-def get_tokens(input_file):
-  tokenizer = Tokenizer(input_file)
-  tree = ET.Element("tokens")
-  while tokenizer.has_tokens():
-    token_type, token = tokenizer.advance()
+def get_tokens(input):
+  tree = Tokens()
+  if isinstance(input, str):
+    input = read_tokens(input)
+  for token_type, token, _, _ in input:
     add(tree, token_type, token)
   return tree
-    
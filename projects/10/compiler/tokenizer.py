@@ -1,4 +1,4 @@
-import collections
+import re
 from enum import Enum
 
 symbols = "{}()[].,;+-*/&|<>=~"
@@ -39,77 +39,77 @@ def token_type_to_str(token):
   else:
     return token.name.lower()
   
+# One master pattern over the whole source. Each match is one token with
+# the whitespace and comments in front of it; the group that matched gives
+# the token's type. Anything unexpected matches as a single character.
+token_pattern = re.compile(r"""
+  \s* (?: (?: //[^\n]* | /\*.*?(?:\*/|\Z) ) \s* )*
+  (?: ([{}()\[\].,;+\-*/&|<>=~])
+    | ([A-Za-z_]\w*)
+    | (\d+)
+    | "([^"\n]*)"
+    | (\Z)
+    | (.) )""", re.S | re.X)
+
+SYMBOL, WORD, INTEGER, STRING, END, ERROR = range(1, 7)
+
+# Yields (type, value, line, col) tokens, lines and columns from 1.
+def scan(text):
+  keyword, identifier = Token.KEYWORD, Token.IDENTIFIER
+  symbol, integer, string = Token.SYMBOL, Token.INT_CONSTANT, \
+                            Token.STR_CONSTANT
+  line = 1
+  line_start = 0
+  next_newline = text.find("\n")
+  for match in token_pattern.finditer(text):
+    group = match.lastindex
+    start = match.start(group)
+    while 0 <= next_newline < start:
+      line += 1
+      line_start = next_newline + 1
+      next_newline = text.find("\n", line_start)
+    value = match.group(group)
+    col = start - line_start + 1
+    if group == WORD:
+      yield (keyword if value in keywords else identifier, value, line, col)
+    elif group == SYMBOL:
+      yield (symbol, value, line, col)
+    elif group == INTEGER:
+      yield (integer, value, line, col)
+    elif group == STRING:
+      yield (string, value, line, col - 1)
+    elif group == END:
+      return
+    elif value == '"':
+      raise Exception("Unterminated string at " + str(line) + ":" + str(col))
+    else:
+      raise Exception("Unexpected character " + repr(value) + " at " + \
+                      str(line) + ":" + str(col))
+
+# Reads and scans a source file once; the resulting list of tokens is
+# shared by every Tokenizer (and anything else) reading that file.
+def read_tokens(filename):
+  with open(filename, 'r') as f:
+    return list(scan(f.read()))
+
+# A cursor over a token list. It takes the list itself, or a filename to
+# read one from; the list is never copied.
 class Tokenizer:
-  def __init__(self, filename):
-    with open(filename, 'r') as f:
-      raw_lines = f.readlines()
-      lines = collections.deque()
-      in_comment = False
-      for line in raw_lines:
-        if in_comment:
-          comment_end = line.find("*/")
-          if comment_end == -1:
-            continue
-          else:
-            line = line[comment_end + 2:]
-            in_comment = False
-        eol_comment = line.find("//")
-        if eol_comment != -1:
-          line = line[:eol_comment]
-        comment_begin = line.find("/*")
-        if comment_begin != -1:
-          comment_end = line.find("*/")
-          if comment_end == -1:
-            in_comment = True
-            line = line[:comment_begin]
-          else:
-            line = line[:comment_begin] + line[comment_end + 2:]
-        line = line.strip()
-        if len(line) > 0:
-          lines.append(line)
-      self.lines = lines
-      self.tokens = collections.deque()
+  def __init__(self, tokens):
+    if isinstance(tokens, str):
+      tokens = read_tokens(tokens)
+    self.tokens = tokens
+    self.pos = 0
+    self.line = 0               # position of the last token returned
+    self.col = 0
 
   def has_tokens(self):
-    return (len(self.lines) > 0 or len(self.tokens) > 0)
+    return self.pos < len(self.tokens)
 
-  def tokenize(self, line):
-    i = 0
-    while i < len(line):
-      if line[i] == " ":
-        i += 1
-        continue
-      elif line[i] in symbols:
-        self.tokens.append((Token.SYMBOL, line[i]))
-        i += 1
-      elif line[i] == '"':
-        # tokenize string literal
-        i += 1
-        s = ""
-        while line[i] != '"':
-          s += line[i]
-          i += 1
-        self.tokens.append((Token.STR_CONSTANT, s))
-        i += 1                # skip the quote
-      elif line[i].isdigit():
-        s = ""
-        while i < len(line) and line[i].isdigit():
-          s += line[i]
-          i += 1
-        self.tokens.append((Token.INT_CONSTANT, s))
-      else:                     # parsing keyword or identifier
-        s = ""
-        while i < len(line) and line[i] not in symbols and line[i] != " ":
-          s += line[i]
-          i += 1
-        if s in keywords:
-          self.tokens.append((Token.KEYWORD, s))
-        else:
-          self.tokens.append((Token.IDENTIFIER, s))
-                     
+  # Returns the next (type, value) pair; its position is in line and col.
   def advance(self):
-    if len(self.tokens) == 0:
-      line = self.lines.popleft()
-      self.tokenize(line)
-    return self.tokens.popleft()
-  
+    if self.pos >= len(self.tokens):
+      raise Exception("Ran out of tokens")
+    token_type, token, self.line, self.col = self.tokens[self.pos]
+    self.pos += 1
+    return (token_type, token)
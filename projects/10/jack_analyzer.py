@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-import argparse, os
+import argparse, glob, hashlib, os, shutil, time
+from concurrent.futures import ProcessPoolExecutor
 from compiler.parser import parse, get_tokens
-import xml.etree.ElementTree as ET
+from compiler.instrument import RuleStats, PrintTrace
+from compiler.nodes import Node
+from compiler.tokenizer import token_type_to_str, scan
+from xml.sax.saxutils import escape
 
 def is_jack_file(filename):
   return (filename.endswith("jack"))
@@ -11,22 +15,18 @@ def output_filenames(input_file):
   compiled_file = input_file[:-5] + "2.xml"
   return (tokens_file, compiled_file)
 
-def get_filenames():
-  parser = argparse.ArgumentParser()
-  parser.add_argument("input")
-  args = parser.parse_args()
-  input_file = args.input
+def get_filenames(input_file):
   print("Input (file or dir): ", input_file)
   if os.path.isfile(input_file):
     if is_jack_file(input_file):
       tokens_file, compiled_file = output_filenames(input_file)
-      return (input_file, tokens_file, compiled_file)
+      return [(input_file, tokens_file, compiled_file)]
     else:
-      raise("Input is not a .jack file")
+      raise Exception("Input is not a .jack file")
   else:                         # input is a directory!
     input_dir = input_file
     out = []
-    for input_file in os.listdir(input_dir):
+    for input_file in sorted(os.listdir(input_dir)):
       if is_jack_file(input_file):
         in_file = os.path.join(input_dir, input_file)
         tokens_file, compiled_file = output_filenames(in_file)
@@ -35,30 +35,133 @@ def get_filenames():
         print('Not a .jack file: ', input_file)
     return out
 
-def to_pretty_string(tree, prefix):
-  children = list(tree)
-  if len(children) == 0 and tree.text != None:
-    return (prefix + ET.tostring(tree, \
-                                 encoding = "unicode", \
-                                 short_empty_elements = False))
-  else:
-    return (prefix + "<" + tree.tag + ">\n" + \
-            "\n".join(map(lambda c : to_pretty_string(c, prefix + "  "), \
-                          children)) + \
-            ("\n" if children else "") + prefix + "</" + tree.tag + ">")
-  
+# Writes the tree as indented XML, one element per line, while walking it;
+# the walk keeps one child iterator per open element instead of recursing.
+# Leaf text is escaped the way ElementTree escapes it.
+def write_pretty(tree, out):
+  write = out.write
+  write("<" + tree.tag + ">")
+  stack = [ (tree, iter(tree.children), "  ") ]
+  while stack:
+    node, children, prefix = stack[-1]
+    child = next(children, None)
+    if child is None:
+      stack.pop()
+      write("\n" + prefix[2:] + "</" + node.tag + ">")
+    elif isinstance(child, Node):
+      write("\n" + prefix + "<" + child.tag + ">")
+      stack.append((child, iter(child.children), prefix + "  "))
+    else:
+      tag = token_type_to_str(child[0])
+      write("\n" + prefix + "<" + tag + ">" + escape(child[1]) + \
+            "</" + tag + ">")
+
 def pretty_dump(tree, out):
-  with open(out, 'w') as out:
-    out.write(to_pretty_string(tree, ""))
-  
+  with open(out, 'w', buffering = 1 << 16) as out:
+    write_pretty(tree, out)
+
+# On-disk cache of analyzer output. An entry is keyed by a hash of the
+# analyzer and compiler sources and of the .jack file's contents, and holds
+# both XML files, so an unchanged file is not tokenized, parsed or written
+# out again, only copied.
+class OutputCache:
+  def __init__(self, directory):
+    self.directory = directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    version = hashlib.sha1()
+    for source in [ __file__ ] + \
+                  sorted(glob.glob(os.path.join(here, "compiler", "*.py"))):
+      with open(source, 'rb') as f:
+        version.update(f.read())
+    self.version = version.hexdigest()
+    os.makedirs(directory, exist_ok = True)
+
+  # Cached (tokens file, compiled file) for this source text.
+  def entry(self, text):
+    key = hashlib.sha1((self.version + "\n" + text).encode()).hexdigest()
+    base = os.path.join(self.directory, key)
+    return (base + "T.xml", base + ".xml")
+
+  def lookup(self, text, outputs):
+    cached = self.entry(text)
+    if not all([ os.path.isfile(path) for path in cached ]):
+      return False
+    for path, out in zip(cached, outputs):
+      shutil.copyfile(path, out)
+    return True
+
+  def store(self, text, outputs):
+    for out, path in zip(outputs, self.entry(text)):
+      shutil.copyfile(out, path + ".tmp")
+      os.replace(path + ".tmp", path)
+
+# Analyzes one file, in this process or a worker. Returns whether the cache
+# had it, the time taken and the rule stats gathered (if asked for).
+def analyze(job):
+  input_file, tokens_file, compiled_file, cache, trace, collect_stats = job
+  start = time.perf_counter()
+  stats = RuleStats() if collect_stats else None
+  with open(input_file, 'r') as f:
+    text = f.read()
+  outputs = (tokens_file, compiled_file)
+  if cache is not None and cache.lookup(text, outputs):
+    return (True, time.perf_counter() - start, stats)
+  # Scanned once; the token dump and the parser share the list.
+  source = list(scan(text))
+  pretty_dump(get_tokens(source), tokens_file)
+  pretty_dump(parse(source, trace, stats), compiled_file)
+  if cache is not None:
+    cache.store(text, outputs)
+  return (False, time.perf_counter() - start, stats)
+
+def analyze_files(files, cache, trace, collect_stats, jobs = 1):
+  work = [ (input_file, tokens_file, compiled_file, cache, trace,
+            collect_stats)
+           for input_file, tokens_file, compiled_file in files ]
+  if jobs > 1:
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+      yield from pool.map(analyze, work)
+  else:
+    for job in work:
+      yield analyze(job)
+
 def main():
-  files = get_filenames()
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input")
+  parser.add_argument("--trace", action = "store_true",
+                      help = "print every parser rule and token")
+  parser.add_argument("--stats", action = "store_true",
+                      help = "print calls and time per parser rule")
+  parser.add_argument("--cache", nargs = "?", const = "", metavar = "DIR",
+                      help = "reuse the output for unchanged files from DIR "
+                             "(default: .jackcache next to the input)")
+  parser.add_argument("--jobs", type = int, default = 1, metavar = "N",
+                      help = "analyze the files in N processes")
+  args = parser.parse_args()
+  trace = PrintTrace() if args.trace else None
+  stats = RuleStats() if args.stats else None
+  files = get_filenames(args.input)
+  cache = None
+  if args.cache is not None:
+    cache = OutputCache(args.cache or
+                        os.path.join(os.path.dirname(files[0][0]) if files
+                                     else args.input, ".jackcache"))
   for (input_file, tokens_file, compiled_file) in files:
     print("Parsing ", input_file, "into tokens file ", tokens_file, "and compiled file", compiled_file)
-    tokens = get_tokens(input_file)
-    ast = parse(input_file)
-    pretty_dump(tokens, tokens_file)
-    pretty_dump(ast, compiled_file)
+  hits = 0
+  total = 0.0
+  results = analyze_files(files, cache, trace, stats is not None, args.jobs)
+  for (input_file, _, _), (hit, elapsed, file_stats) in zip(files, results):
+    print("  {0:40} {1:>8.1f} ms{2}".format(
+      input_file, 1000 * elapsed, " (cached)" if hit else ""))
+    hits += hit
+    total += elapsed
+    if file_stats is not None:
+      stats.merge(file_stats)
+  print("Files: ", len(files), "analyzed,", hits, "from the cache,",
+        "{0:.1f} ms".format(1000 * total))
+  if stats is not None:
+    print(stats.report())
   
 if __name__ == "__main__":
   main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Compiles .jack files to .vm files (Foo.jack -> Foo.vm next to it). The
+# code is generated while parsing and written out as it is produced.
+import argparse, os, time
+from compiler.codegen import compile_class
+from compiler.instrument import RuleStats
+from compiler.tokenizer import read_tokens
+
+def get_filenames(input_file):
+  if os.path.isfile(input_file):
+    if not input_file.endswith(".jack"):
+      raise Exception("Input is not a .jack file")
+    return [ input_file ]
+  return [ os.path.join(input_file, name)
+           for name in sorted(os.listdir(input_file))
+           if name.endswith(".jack") ]
+
+def compile_file(input_file, stats = None, optimize = False):
+  output_file = input_file[:-5] + ".vm"
+  tokens = read_tokens(input_file)
+  with open(output_file, 'w', buffering = 1 << 16) as out:
+    compile_class(tokens, out.write, stats = stats, optimize = optimize)
+  return output_file
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input", help = ".jack file or directory")
+  parser.add_argument("-O", "--optimize", action = "store_true",
+                      help = "fold constants and reduce multiplications "
+                             "by small constants to additions")
+  parser.add_argument("--stats", action = "store_true",
+                      help = "print calls and time per parser rule")
+  args = parser.parse_args()
+  stats = RuleStats() if args.stats else None
+  start = time.perf_counter()
+  files = get_filenames(args.input)
+  for input_file in files:
+    print("Compiling ", input_file, "into", compile_file(input_file, stats,
+                                                        args.optimize))
+  print("Files: ", len(files), "compiled in",
+        "{0:.1f} ms".format(1000 * (time.perf_counter() - start)))
+  if stats is not None:
+    print(stats.report())
+
+if __name__ == "__main__":
+  main()
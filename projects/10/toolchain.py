@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Builds a directory of .jack files into Hack ROM words in one process.
+# The stages run as a chain in memory: each class is tokenized and compiled
+# to VM commands, the commands are translated to assembly (vm_to_hack.py)
+# and the assembly is assembled to words (assembler.py). The .vm, .asm and
+# .hack files are only written when asked for.
+import argparse, glob, os, sys, time
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path += [ os.path.join(here, "..", "08"), os.path.join(here, "..", "06") ]
+import assembler, hack_rom, peephole, vm_to_hack
+from compiler.codegen import compile_class
+from compiler.tokenizer import read_tokens
+
+# (class name, path) of the classes to build. Classes come from the
+# libraries (e.g. an OS) unless the directory itself defines them.
+def jack_files(directory, libraries = ()):
+  classes = {}
+  for d in list(libraries) + [ directory ]:
+    for path in sorted(glob.glob(os.path.join(d, "*.jack"))):
+      classes[os.path.basename(path)[:-5]] = path
+  return sorted(classes.items())
+
+# (filename prefix, VM commands) per class, as vm_to_hack.load_programs
+# would read them from the .vm files.
+def compile_classes(files, optimize = False, keep = False):
+  for name, path in files:
+    lines = []
+    compile_class(read_tokens(path), lines.append, optimize = optimize)
+    if keep:
+      with open(path[:-5] + ".vm", 'w') as out:
+        out.write("".join(lines))
+    yield (name + ".", "".join(lines).splitlines())
+
+def asm_lines(chunks):
+  for chunk in chunks:
+    yield from chunk.split("\n")
+
+def output_name(directory):
+  return os.path.join(directory,
+                      os.path.basename(os.path.abspath(directory)))
+
+# Returns the ROM words of the program in directory. optimize is the
+# level of vm_to_hack.py -O; any level also folds constants in the
+# compiler. The bootstrap (SP = 256, call Sys.init) is added if there is
+# a Sys class. keep writes each stage's files like the separate tools do.
+def build(directory, libraries = (), optimize = 0, shared = False,
+          eliminate = False, peephole_pass = False, keep = False):
+  files = jack_files(directory, libraries)
+  if not files:
+    raise Exception("No .jack files in " + directory)
+  write_bootstrap = "Sys" in dict(files)
+  programs = compile_classes(files, optimize > 0, keep)
+  if eliminate and write_bootstrap:
+    programs, _ = vm_to_hack.strip_dead_functions(list(programs))
+  asm = vm_to_hack.translate_programs(programs, write_bootstrap, optimize,
+                                      shared)
+  if peephole_pass:
+    asm = [ peephole.optimize_text("".join(asm))[0] ]
+  if keep:
+    asm = list(asm)
+    with open(output_name(directory) + ".asm", 'w') as out:
+      out.writelines(asm)
+  words = hack_rom.to_array(assembler.assemble(asm_lines(asm)))
+  if keep:
+    with open(output_name(directory) + ".hack", 'w') as out:
+      hack_rom.write_hack(words, out)
+  return words
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("input", help = "directory of .jack files")
+  parser.add_argument("--lib", action = "append", default = [],
+                      metavar = "DIR",
+                      help = "take missing classes from DIR (e.g. an OS)")
+  parser.add_argument("-O", "--optimize", action = "count", default = 0,
+                      help = "fold constants in the compiler and optimize "
+                             "the translation as vm_to_hack.py -O does")
+  parser.add_argument("-S", "--shared", action = "store_true",
+                      help = "as vm_to_hack.py -S")
+  parser.add_argument("-E", "--eliminate-dead", action = "store_true",
+                      help = "as vm_to_hack.py -E")
+  parser.add_argument("-P", "--peephole", action = "store_true",
+                      help = "run peephole.py over the assembly")
+  parser.add_argument("--keep", action = "store_true",
+                      help = "write the .vm, .asm and .hack files")
+  parser.add_argument("--binary", action = "store_true",
+                      help = "write a .rom image of the program")
+  args = parser.parse_args()
+  start = time.perf_counter()
+  words = build(args.input, args.lib, args.optimize, args.shared,
+                args.eliminate_dead, args.peephole, args.keep)
+  elapsed = time.perf_counter() - start
+  if args.binary:
+    hack_rom.write_rom(words, output_name(args.input) + ".rom")
+  print("ROM size: ", len(words), "words, built in",
+        "{0:.1f} ms".format(1000 * elapsed))
+
+if __name__ == "__main__":
+  main()